@@ -0,0 +1,94 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def date_rows(dates, start=None, end=None):
+
+    # Row slice of a sorted datetime64[ns] array covering start <= date <= end. None leaves that end open
+    lo = 0 if start is None else np.searchsorted(dates, np.datetime64(start, 'ns'), side='left')
+    hi = len(dates) if end is None else np.searchsorted(dates, np.datetime64(end, 'ns'), side='right')
+
+    return lo, max(lo, hi)
+
+
+class RangeAggregates:
+
+    # Per-district sums, counts and means over any [start, end] date range in constant time.
+    # Values are laid out as a dates x districts x columns array and we keep running totals down the date axis,
+    # so a range is two binary searches on the dates and a subtraction of two rows.
+
+    def __init__(self, dates, districts, values):
+
+        # values maps a column name to a dates x districts array, NaN where there's no observation
+        self.dates = np.asarray(dates, dtype='datetime64[ns]')
+        self.districts = pd.Index(districts, name='District')
+        self.columns = pd.Index(list(values))
+
+        matrix = np.stack([np.asarray(values[column], dtype=float) for column in self.columns], axis=-1)
+        present = ~np.isnan(matrix)
+
+        # Leading row of zeros so the total for rows [lo, hi) is always cum[hi] - cum[lo]
+        self.sums = np.zeros((matrix.shape[0] + 1,) + matrix.shape[1:])
+        self.counts = np.zeros((matrix.shape[0] + 1,) + matrix.shape[1:], dtype=np.int64)
+        np.cumsum(np.where(present, matrix, 0.0), axis=0, out=self.sums[1:])
+        np.cumsum(present, axis=0, out=self.counts[1:])
+
+    @classmethod
+    def from_totals(cls, dates, districts, columns, sums, counts):
+
+        # Wrap running totals computed earlier, e.g. arrays mapped from files saved by save()
+        aggregates = cls.__new__(cls)
+        aggregates.dates = np.asarray(dates, dtype='datetime64[ns]')
+        aggregates.districts = pd.Index(districts, name='District')
+        aggregates.columns = pd.Index(list(columns))
+        aggregates.sums = sums
+        aggregates.counts = counts
+
+        return aggregates
+
+    def save(self, prefix):
+
+        # Running totals as .npy files next to each other, renamed into place so readers never map half of one
+        for name, values in (('sums', self.sums), ('counts', self.counts)):
+            temporary = '{}.{}.{}.tmp'.format(prefix, name, os.getpid())
+            with open(temporary, 'wb') as f:
+                np.save(f, values)
+            os.replace(temporary, '{}.{}.npy'.format(prefix, name))
+
+    @classmethod
+    def load(cls, prefix, dates, districts, columns):
+
+        # Map totals saved by save() read-only, so every process using them shares the same pages
+        sums = np.load(prefix + '.sums.npy', mmap_mode='r')
+        counts = np.load(prefix + '.counts.npy', mmap_mode='r')
+        if sums.shape != (len(dates) + 1, len(districts), len(columns)) or counts.shape != sums.shape:
+            raise ValueError('saved totals at {} do not match the dataset'.format(prefix))
+
+        return cls.from_totals(dates, districts, columns, sums, counts)
+
+    def rows(self, start, end):
+        return date_rows(self.dates, start, end)
+
+    def frame(self, values):
+        return pd.DataFrame(values, index=self.districts, columns=self.columns)
+
+    def sum(self, start, end):
+        lo, hi = self.rows(start, end)
+        return self.frame(self.sums[hi] - self.sums[lo])
+
+    def count(self, start, end):
+        lo, hi = self.rows(start, end)
+        return self.frame(self.counts[hi] - self.counts[lo])
+
+    def mean(self, start, end):
+
+        lo, hi = self.rows(start, end)
+        counts = self.counts[hi] - self.counts[lo]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = (self.sums[hi] - self.sums[lo]) / counts
+
+        # Same shape as groupby(['District']).mean(): districts with no rows in the range are left out
+        return self.frame(means)[counts.any(axis=1)]
@@ -0,0 +1,154 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import flask
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Read-only data API on the dashboard's Flask server, answered from the same snapshot the chart callbacks use.
+#
+#   /api/v1/dataset                                   version, date range and districts
+#   /api/v1/aggregates?start=2020-11-01&end=2020-11-30 per-district averages and totals over the dates, inclusive
+#
+# Aggregates come as JSON, or as an Arrow IPC stream with format=arrow (or Accept: application/vnd.apache.arrow.stream)
+# when pyarrow is installed. Responses carry an ETag derived from the dataset version and the query, so repeat
+# requests get a 304 and HTTP caches can serve them until the data changes. Compression is left to Flask-Compress.
+#
+# The ETags are weak: the same data goes out identity, gzip or brotli encoded. Flask-Compress appends the coding to
+# strong ETags ("abc:gzip") on newer versions and leaves them alone on older ones, where the three bodies then share
+# one strong validator. Weak ones it passes through, and the match below ignores a coding suffix either way.
+
+# Seconds clients and caches may reuse a response before revalidating it
+MAX_AGE = int(os.environ.get('COVID_API_MAX_AGE', 300))
+
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+
+
+def error(status, message):
+    response = flask.jsonify({'error': message})
+    response.status_code = status
+    return response
+
+
+def parse_date(value, default):
+    if not value:
+        return default
+    return datetime.strptime(value[:10], '%Y-%m-%d')
+
+
+def wants_arrow():
+    requested = flask.request.args.get('format')
+    if requested:
+        return requested == 'arrow'
+
+    accept = flask.request.accept_mimetypes
+
+    return accept.best_match(['application/json', ARROW_MIMETYPE]) == ARROW_MIMETYPE and accept[ARROW_MIMETYPE] > accept['application/json']
+
+
+def conditional(version, *query):
+
+    # ETag for this query on this dataset version, and whether the client already has it in any encoding
+    etag = hashlib.sha1(json.dumps([version] + list(query)).encode()).hexdigest()[:20]
+    sent = flask.request.if_none_match
+
+    return etag, sent.star_tag or etag in {tag.split(':')[0] for tag in sent.as_set(include_weak=True)}
+
+
+def cacheable(response, etag):
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'public, max-age={}'.format(MAX_AGE)
+    response.vary.add('Accept')
+    return response
+
+
+def not_modified(etag):
+    return cacheable(flask.Response(status=304), etag)
+
+
+def range_aggregates(data, start, end):
+
+    # One row per district with observations in the range, in district order
+    incidence = data.incidence_aggregates
+    rolling = data.rolling_aggregates
+
+    sums = incidence.sum(start, end)
+    counts = incidence.count(start, end)
+    means = incidence.mean(start, end)
+    rolling_means = rolling.mean(start, end).reindex(means.index)
+
+    frame = pd.DataFrame({'days': counts['Incidence'].reindex(means.index).astype(np.int64),
+                          'total_cases': sums['Cases'].reindex(means.index),
+                          'mean_daily_cases': means['Cases'],
+                          'mean_incidence': means['Incidence'],
+                          'mean_rolling_cases': rolling_means['Cases']}, index=means.index)
+
+    return frame.reset_index()
+
+
+def install(server, datasets):
+
+    # datasets is the DatasetHandle the callbacks read from
+
+    @server.route('/api/v1/dataset')
+    def api_dataset():
+        data = datasets.current()
+        etag, fresh = conditional(data.version, 'dataset')
+        if fresh:
+            return not_modified(etag)
+
+        dates = data.dataset.dates
+        return cacheable(flask.jsonify({'version': data.version,
+                                        'start': str(dates[0])[:10] if len(dates) else None,
+                                        'end': str(dates[-1])[:10] if len(dates) else None,
+                                        'days': len(dates),
+                                        'districts': list(data.dataset.districts)}), etag)
+
+    @server.route('/api/v1/aggregates')
+    def api_aggregates():
+        data = datasets.current()
+        dates = data.dataset.dates
+        if not len(dates):
+            return error(404, 'no data')
+
+        try:
+            start = parse_date(flask.request.args.get('start'), pd.Timestamp(dates[0]).to_pydatetime())
+            end = parse_date(flask.request.args.get('end'), pd.Timestamp(dates[-1]).to_pydatetime())
+        except ValueError:
+            return error(400, 'start and end must be dates as YYYY-MM-DD')
+        if end < start:
+            return error(400, 'end is before start')
+
+        arrow = wants_arrow()
+        if arrow and pa is None:
+            return error(406, 'Arrow output needs pyarrow installed on the server')
+
+        # Check the ETag before doing any work, a match is answered without touching the data
+        query = [start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'), 'arrow' if arrow else 'json']
+        etag, fresh = conditional(data.version, *query)
+        if fresh:
+            return not_modified(etag)
+
+        frame = range_aggregates(data, start, end)
+
+        if arrow:
+            table = pa.Table.from_pandas(frame, preserve_index=False).replace_schema_metadata(
+                {'version': data.version, 'start': query[0], 'end': query[1]})
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            response = flask.Response(sink.getvalue().to_pybytes(), mimetype=ARROW_MIMETYPE)
+
+        else:
+            # NaN (a district with no rolling average yet) goes out as null
+            records = frame.astype(object).where(frame.notna(), None).to_dict(orient='records')
+            response = flask.jsonify({'version': data.version, 'start': query[0], 'end': query[1], 'districts': records})
+
+        return cacheable(response, etag)
@@ -0,0 +1,180 @@
+// Browser-side versions of the four chart callbacks in covid_dash.py, used when COVID_CLIENTSIDE=1.
+// They read the compact dataset from the dataset-store (see clientside.py) and never call the server.
+
+(function () {
+    var DAY = 86400000;
+
+    function epochDay(dateString) {
+        // Days since 1970-01-01 for the YYYY-MM-DD part of a date picker value
+        var parts = dateString.slice(0, 10).split('-');
+        return Date.UTC(+parts[0], +parts[1] - 1, +parts[2]) / DAY;
+    }
+
+    function isoDate(day) {
+        return new Date(day * DAY).toISOString().slice(0, 10);
+    }
+
+    function rowRange(data, startDate, endDate) {
+        var first = epochDay(data.start);
+        var start = epochDay(startDate);
+        var end = epochDay(endDate);
+        var lo = 0;
+        while (lo < data.days.length && first + data.days[lo] < start) {
+            lo++;
+        }
+        var hi = lo;
+        while (hi < data.days.length && first + data.days[hi] <= end) {
+            hi++;
+        }
+        return [lo, hi];
+    }
+
+    function rowDays(data, range) {
+        // Epoch days of the rows in a range
+        var first = epochDay(data.start);
+        return data.days.slice(range[0], range[1]).map(function (offset) { return first + offset; });
+    }
+
+    function bucketKey(day, bucket) {
+        if (bucket === 'week') {
+            // 1970-01-01 was a Thursday, so shift by 3 days to start weeks on Monday
+            return Math.floor((day + 3) / 7);
+        }
+        if (bucket === 'month') {
+            var date = new Date(day * DAY);
+            return date.getUTCFullYear() * 12 + date.getUTCMonth();
+        }
+        return day;
+    }
+
+    function chooseBucket(days, nSeries, budget) {
+        // Finest bucket that keeps bars under the budget, like downsample.choose_bucket
+        var buckets = ['day', 'week', 'month'];
+        for (var b = 0; b < buckets.length; b++) {
+            var count = 0;
+            var last = null;
+            for (var i = 0; i < days.length; i++) {
+                var key = bucketKey(days[i], buckets[b]);
+                if (key !== last) {
+                    count++;
+                    last = key;
+                }
+            }
+            if (count * nSeries <= budget) {
+                return buckets[b];
+            }
+        }
+        return 'month';
+    }
+
+    function mean(values) {
+        var sum = 0;
+        var count = 0;
+        for (var i = 0; i < values.length; i++) {
+            if (values[i] !== null) {
+                sum += values[i];
+                count++;
+            }
+        }
+        return count ? sum / count : null;
+    }
+
+    var BUCKET_TITLES = {day: 'Date', week: 'Week starting', month: 'Month'};
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        covid: {
+            bar: function (nClicks, startDate, endDate, data) {
+                var range = rowRange(data, startDate, endDate);
+                var days = rowDays(data, range);
+                var bucket = chooseBucket(days, data.districts.length, data.bar_points);
+
+                var traces = data.districts.map(function (district, d) {
+                    var column = data.rolling_cases[d].slice(range[0], range[1]);
+                    var x = [];
+                    var y = [];
+                    var i = 0;
+                    // Average each run of days sharing a bucket, labelled with its first date
+                    while (i < days.length) {
+                        var key = bucketKey(days[i], bucket);
+                        var j = i;
+                        while (j < days.length && bucketKey(days[j], bucket) === key) {
+                            j++;
+                        }
+                        var value = mean(column.slice(i, j));
+                        if (value !== null) {
+                            x.push(isoDate(days[i]));
+                            y.push(value);
+                        }
+                        i = j;
+                    }
+                    return {type: 'bar', name: district, x: x, y: y,
+                            marker: {color: data.colors.bar[d % data.colors.bar.length]}};
+                });
+
+                return {data: traces,
+                        layout: {barmode: 'relative', hovermode: 'closest', width: 1250, height: 475,
+                                 legend: {title: {text: 'District'}},
+                                 xaxis: {title: {text: BUCKET_TITLES[bucket]}}, yaxis: {title: {text: 'Cases'}}}};
+            },
+
+            box: function (nClicks, startDate, endDate, data) {
+                var range = rowRange(data, startDate, endDate);
+
+                // Every point goes to plotly.js, which computes the boxes itself
+                var traces = data.districts.map(function (district, d) {
+                    var x = data.incidence[d].slice(range[0], range[1]).filter(function (value) {
+                        return value !== null;
+                    });
+                    return {type: 'box', name: district, orientation: 'h', notched: true, boxpoints: 'all',
+                            x: x, y: x.map(function () { return district; }),
+                            marker: {color: data.colors.box[d % data.colors.box.length]}};
+                });
+
+                return {data: traces,
+                        layout: {hovermode: 'closest', width: 1250, height: 475,
+                                 legend: {title: {text: 'District'}},
+                                 xaxis: {title: {text: 'Incidence'}}, yaxis: {title: {text: 'District'}}}};
+            },
+
+            incidence_bar: function (nClicks, startDate, endDate, data) {
+                var districts = averageIncidence(data, startDate, endDate);
+
+                return {data: [{type: 'bar', orientation: 'h',
+                                x: districts.map(function (row) { return row[1]; }),
+                                y: districts.map(function (row) { return row[0]; }),
+                                marker: {color: 'darkturquoise'}}],
+                        layout: {width: 1250, height: 475,
+                                 xaxis: {title: {text: 'Incidence'}}, yaxis: {title: {text: 'District'}}}};
+            },
+
+            map: function (nClicks, startDate, endDate, data) {
+                var districts = averageIncidence(data, startDate, endDate);
+                var scale = data.colors.map;
+
+                return {data: [{type: 'choropleth',
+                                geojson: data.map.geojson,
+                                featureidkey: data.map.featureidkey,
+                                locations: districts.map(function (row) { return row[0]; }),
+                                z: districts.map(function (row) { return row[1]; }),
+                                colorscale: scale.map(function (color, i) { return [i / (scale.length - 1), color]; }),
+                                colorbar: {title: {text: 'Incidence'}}}],
+                        layout: {height: data.map.height,
+                                 margin: {r: 0, t: 0, l: 0, b: 0},
+                                 geo: {fitbounds: 'locations', visible: false, projection: {type: 'mercator'}}}};
+            }
+        }
+    });
+
+    function averageIncidence(data, startDate, endDate) {
+        // [district, mean incidence] for districts with data in the range, sorted by incidence
+        var range = rowRange(data, startDate, endDate);
+        var rows = [];
+        data.districts.forEach(function (district, d) {
+            var value = mean(data.incidence[d].slice(range[0], range[1]));
+            if (value !== null) {
+                rows.push([district, value]);
+            }
+        });
+        return rows.sort(function (a, b) { return a[1] - b[1]; });
+    }
+})();
@@ -0,0 +1,761 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from urllib.request import Request, urlopen
+
+import flask
+import numpy as np
+import pandas as pd
+import plotly.express as px
+from geojson_rewind import rewind
+
+import geometry
+import dataset
+from datahandle import DatasetHandle, build_snapshot
+from boxstats import box_figure, box_stats
+from downsample import choose_bucket, bucket_means
+
+SCRAPE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'covid scrape')
+
+# The scrape folder has the benchmark helpers both folders share, and the scrape modules some sections use
+sys.path.append(SCRAPE_DIR)
+from benchtools import timed, report, measure, results_table
+
+# Benchmarks for the dashboard data paths. Run one section with e.g. `python benchmark.py geometry`
+
+
+def bench_geometry(args):
+
+    berlin_districts = geometry.load_geojson(args.geojson)
+    if not berlin_districts['features']:
+        print('no district polygons, pass --geojson or set BERLIN_GEOJSON')
+        return 1
+    names = [feature['properties'][geometry.FEATURE_KEY] for feature in berlin_districts['features']]
+    raw = json.dumps(berlin_districts)
+    districts = {'District': names, 'Incidence': np.random.default_rng(0).random(len(names)) * 30}
+
+    def choropleth(geojson):
+        fig = px.choropleth(districts, geojson=geojson, locations='District', color='Incidence',
+                            featureidkey='properties.' + geometry.FEATURE_KEY, projection='mercator')
+        fig.update_geos(fitbounds='locations', visible=False)
+        return fig.to_json()
+
+    # Before: parse and rewind the full polygons on every request
+    def before():
+        return choropleth(rewind(json.loads(raw), rfc7946=False))
+
+    seconds, payload = timed(before)
+    report('load + rewind per request', seconds, len(payload))
+
+    # After: cached levels built once at startup
+    seconds, _ = timed(lambda: geometry.load_levels(args.geojson), repeat=1)
+    report('startup: build all levels (once)', seconds)
+
+    for level in geometry.SIMPLIFY_LEVELS:
+        seconds, payload = timed(lambda: choropleth(geometry.district_geometry(level)))
+        report('cached level: ' + level, seconds, len(payload))
+
+    seconds, payload = timed(lambda: choropleth(geometry.geometry_for_viewport(1250, 450)))
+    report('cached viewport level (1250x450)', seconds, len(payload))
+
+
+def synthetic_dataset(years, n_districts=12, seed=0):
+
+    # Daily cases as a noisy seasonal wave per district, with rolling averages and incidence derived like the scrape does
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2020-03-03', periods=int(years * 365), freq='D')
+    districts = ['District {}'.format(i + 1) for i in range(n_districts)]
+
+    t = np.arange(len(dates))[:, None]
+    level = rng.uniform(20, 200, n_districts) * (1.2 + np.sin(2 * np.pi * t / 365 + rng.uniform(0, 2 * np.pi, n_districts)))
+    daily_cases = rng.poisson(level).astype(np.int32)
+    population = rng.integers(200000, 400000, n_districts)
+
+    arrays = {'daily_cases': daily_cases,
+              'rolling_cases': pd.DataFrame(daily_cases).rolling(7).mean().values,
+              'incidence': daily_cases / population * 100000}
+
+    return dataset.Dataset(dates.values, districts, arrays, 'synthetic-{}'.format(seed))
+
+
+def random_ranges(dates, count, seed=0):
+
+    # Random [start, end] pairs inside the data, some of them starting and ending outside it
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(dates.min() - pd.Timedelta(days=10), dates.max() + pd.Timedelta(days=10))
+    pairs = np.sort(rng.integers(0, len(days), size=(count, 2)), axis=1)
+
+    return [(days[lo].to_pydatetime(), days[hi].to_pydatetime()) for lo, hi in pairs]
+
+
+def bench_aggregates(args):
+
+    incidence = pd.read_csv(args.incidence, parse_dates=['Date'], index_col='Date')
+    rolling_7_long = pd.read_csv(os.path.join(SCRAPE_DIR, 'rolling_7_long.csv'), parse_dates=['Date'], index_col='Date')
+    aggregates = dataset.Dataset.from_long_frames(rolling_7_long, incidence).aggregates(dataset.INCIDENCE_COLUMNS)
+    ranges = random_ranges(incidence.index, args.queries)
+
+    def pandas_mean(start, end):
+        filtered_df = incidence[(incidence.index >= start) & (incidence.index <= end)]
+        return filtered_df.groupby(['District']).mean()
+
+    # Both paths have to agree on every range before the timings mean anything
+    for start, end in ranges:
+        expected = pandas_mean(start, end)
+        actual = aggregates.mean(start, end).sort_index()
+        pd.testing.assert_frame_equal(actual[expected.columns], expected, check_names=False, check_index_type=False)
+    print('prefix-sum means match pandas on {} ranges'.format(len(ranges)))
+
+    seconds, _ = timed(lambda: [pandas_mean(start, end) for start, end in ranges], repeat=3)
+    report('filter + groupby mean ({} ranges)'.format(len(ranges)), seconds)
+
+    seconds, _ = timed(lambda: [aggregates.mean(start, end) for start, end in ranges], repeat=3)
+    report('prefix-sum mean ({} ranges)'.format(len(ranges)), seconds)
+
+
+def bench_startup(args):
+
+    csv_paths = {'rolling_7_long': os.path.join(SCRAPE_DIR, 'rolling_7_long.csv'), 'incidence': args.incidence}
+
+    # Before: every worker parses both CSVs
+    seconds, csv_dataset = timed(lambda: dataset.read_csv_dataset(csv_paths))
+    report('parse CSVs', seconds)
+
+    # After: map the columnar files
+    seconds, mapped = timed(lambda: dataset.open_dataset(args.data))
+    report('memory-map columnar dataset', seconds)
+
+    # The charts have to get the same frames either way
+    for columns in (dataset.ROLLING_COLUMNS, dataset.INCIDENCE_COLUMNS):
+        expected = csv_dataset.long_frame(columns)
+        actual = mapped.long_frame(columns)
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+    print('memory-mapped frames match the CSV frames')
+
+
+def plotly_quantile(values, p):
+
+    # plotly.js Lib.interp, which box traces use for their quartiles
+    values = np.sort(values[~np.isnan(values)])
+    position = p * len(values) - 0.5
+    if position < 0:
+        return values[0]
+    if position > len(values) - 1:
+        return values[-1]
+    fraction = position % 1
+
+    return fraction * values[int(np.ceil(position))] + (1 - fraction) * values[int(np.floor(position))]
+
+
+def bench_box(args):
+
+    data = dataset.open_dataset(args.data)
+    colors = px.colors.qualitative.Set2
+
+    # Quartiles have to agree with what plotly.js draws from the raw points, for the whole history and a short range
+    # where the interpolation methods differ most
+    incidence = data.window('incidence')
+    for values in (incidence, incidence[-58:]):
+        stats = box_stats(values)
+        quartiles = [[plotly_quantile(values[:, i], p) for i in range(values.shape[1])] for p in (0.25, 0.5, 0.75)]
+        np.testing.assert_allclose(np.column_stack([stats['q1'], stats['median'], stats['q3']]), np.transpose(quartiles))
+    print('server-side quartiles match plotly.js')
+    frame = data.long_frame(dataset.INCIDENCE_COLUMNS)
+
+    # Before: every observation goes into the figure and the browser computes the boxes
+    def client():
+        fig = px.box(frame, x='Incidence', y='District', color='District', points='all', notched=True,
+                     color_discrete_sequence=colors, width=1250, height=475)
+        return fig.to_json()
+
+    seconds, payload = timed(client)
+    report('px.box, points=all', seconds, len(payload))
+
+    # After: precomputed statistics, with and without a capped point overlay
+    for max_points in (0, 50):
+        seconds, payload = timed(lambda: box_figure(data.window('incidence'), data.districts, colors, max_points).to_json())
+        report('server stats, {} sampled points'.format(max_points), seconds, len(payload))
+
+
+def bench_bars(args):
+
+    colors = px.colors.qualitative.Dark2
+
+    def bar_chart(data, bucket_points):
+        dates = data.dates
+        bucket = choose_bucket(dates, len(data.districts), bucket_points) if bucket_points else 'day'
+        bucket_dates, cases = bucket_means(dates, data.arrays['rolling_cases'], bucket)
+        frame = dataset.melt(bucket_dates, data.districts, {'Cases': cases})
+        return px.bar(frame, x=frame.index, y='Cases', color='District', color_discrete_sequence=colors,
+                      width=1250, height=475).to_json()
+
+    # Whole history selected, daily bars against the bucketed chart, as the series gets longer
+    for years in (1, 3, 5, 10):
+        data = synthetic_dataset(years)
+        seconds, payload = timed(lambda: bar_chart(data, 0), repeat=3)
+        report('{:>2} years, daily bars'.format(years), seconds, len(payload))
+        seconds, payload = timed(lambda: bar_chart(data, args.bar_points), repeat=3)
+        report('{:>2} years, budget {} bars'.format(years, args.bar_points), seconds, len(payload))
+
+
+def bench_callbacks(args):
+
+    # Every chart builder in covid_dash.py on synthetic datasets of growing size, over the full range and without
+    # the figure cache. The map always draws Berlin's polygons, so only its data part grows
+    import covid_dash
+
+    rows = []
+    for n_districts in args.districts:
+        for years in args.years:
+            data = synthetic_dataset(years, n_districts)
+            start, end = pd.Timestamp(data.dates[0]).to_pydatetime(), pd.Timestamp(data.dates[-1]).to_pydatetime()
+
+            seconds, peak, aggregates = measure(lambda: data.aggregates(dataset.INCIDENCE_COLUMNS))
+            rows.append({'stage': 'range aggregates', 'districts': n_districts, 'years': years,
+                         'ms': round(seconds * 1000, 2), 'peak_kb': peak // 1024, 'bytes': 0})
+
+            snapshot = build_snapshot(data)._replace(incidence_aggregates=aggregates)
+
+            for name, build in [('update_bar_graph', covid_dash.bar_figure),
+                                ('update_box_graph', covid_dash.box_spread_figure),
+                                ('update_bar_graph_incidence', covid_dash.incidence_bar_figure),
+                                ('incidence_map', covid_dash.incidence_map_figure)]:
+                # Figure build plus the JSON serialization Dash does on the way out
+                seconds, peak, payload = measure(lambda: build.uncached(snapshot, start, end).to_json(), args.repeat)
+                rows.append({'stage': name, 'districts': n_districts, 'years': years,
+                             'ms': round(seconds * 1000, 2), 'peak_kb': peak // 1024, 'bytes': len(payload)})
+
+    return results_table(rows, args)
+
+
+# Figure callbacks by tab: (tab, output id, submit button, date picker)
+CHART_CALLBACKS = [('tab-2', 'bar_graph', 'submit-button1', 'date_picker1'),
+                   ('tab-3', 'box_graph', 'submit-button2', 'date_picker2'),
+                   ('tab-4', 'bar_graph_incidence', 'submit-button3', 'date_picker3'),
+                   ('tab-5', 'incidence_map', 'submit-button4', 'date_picker4')]
+
+
+def callback_body(output_id, prop, inputs, state=()):
+
+    # Request body the Dash renderer posts to /_dash-update-component
+    def values(items):
+        return [{'id': component, 'property': name, 'value': value} for component, name, value in items]
+
+    return {'output': '{}.{}'.format(output_id, prop),
+            'outputs': {'id': output_id, 'property': prop},
+            'inputs': values(inputs),
+            'state': values(state),
+            'changedPropIds': ['{}.{}'.format(component, name) for component, name, value in inputs]}
+
+
+def bench_session(args):
+
+    # One visitor opening every chart tab and submitting random ranges, through Flask's test client.
+    # Run once as is and once with COVID_CLIENTSIDE=1 to compare
+    import covid_dash
+
+    client = covid_dash.server.test_client()
+    ranges = random_ranges(pd.DatetimeIndex(covid_dash.datasets.current().dataset.dates), args.clicks * len(CHART_CALLBACKS), seed=1)
+    requests = []
+
+    def get(path):
+        start = time.perf_counter()
+        response = client.get(path)
+        requests.append((path, time.perf_counter() - start, len(response.data)))
+
+    def post(name, body):
+        start = time.perf_counter()
+        response = client.post('/_dash-update-component', json=body)
+        assert response.status_code in (200, 204), response.status_code
+        requests.append((name, time.perf_counter() - start, len(response.data)))
+
+    for path in ('/', '/_dash-layout', '/_dash-dependencies'):
+        get(path)
+
+    for i, (tab, output_id, button_id, picker_id) in enumerate(CHART_CALLBACKS):
+        post('render_content', callback_body('dash-tabs-content', 'children', [('dash-tabs', 'value', tab)]))
+
+        # Submit clicks only reach the server when the charts are built there
+        if covid_dash.CLIENTSIDE:
+            continue
+        for click, (start, end) in enumerate(ranges[i * args.clicks:(i + 1) * args.clicks]):
+            post(output_id, callback_body(output_id, 'figure', [(button_id, 'n_clicks', click)],
+                                          [(picker_id, 'start_date', start.strftime('%Y-%m-%d')),
+                                           (picker_id, 'end_date', end.strftime('%Y-%m-%d'))]))
+
+    print('mode: {}, {} Submit clicks per chart'.format('clientside' if covid_dash.CLIENTSIDE else 'server', args.clicks))
+    frame = pd.DataFrame(requests, columns=['request', 'seconds', 'bytes'])
+    summary = frame.groupby('request', sort=False).agg(requests=('seconds', 'size'),
+                                                        mean_ms=('seconds', lambda seconds: seconds.mean() * 1000),
+                                                        bytes=('bytes', 'sum'))
+    print(summary.round(2).to_string())
+    print('total: {} requests, {:,} bytes'.format(len(frame), frame['bytes'].sum()))
+
+
+def resident_kb():
+
+    # Resident set size of this process (Linux)
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def bench_reload(args):
+
+    # Readers keep querying a dataset handle while new days are appended the way `covid_scrape.py --incremental` does.
+    # Every snapshot a reader gets has to be internally consistent, and swaps should show up within the poll interval
+    import columnar
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'data')
+        shutil.copytree(args.data, path)
+        handle = DatasetHandle(path, interval=args.interval)
+        swaps = []
+        handle.listeners.append(lambda snapshot: swaps.append((time.perf_counter(), snapshot.version)))
+        handle.start()
+
+        stop = threading.Event()
+        latencies, failures = [], []
+
+        def reader():
+            while not stop.is_set():
+                start = time.perf_counter()
+                data = handle.current()
+                means = data.incidence_aggregates.mean(data.dataset.dates[0], data.dataset.dates[-1])
+                if len(data.incidence_aggregates.dates) != len(data.dataset.dates) or means.empty:
+                    failures.append(data.version)
+                latencies.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=reader) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+
+        rss_before = resident_kb()
+        appended = []
+        for _ in range(args.appends):
+            manifest = columnar.read_manifest(path)
+            last = columnar.last_date(manifest, path)
+            arrays = {name: columnar.read_tail(path, manifest, name, 1) for name in columnar.ARRAYS}
+            appended.append((time.perf_counter(), columnar.append_rows(path, [last + 1], arrays)['version']))
+            time.sleep(args.interval * 3)
+
+        stop.set()
+        for thread in threads:
+            thread.join()
+        handle.stop()
+
+        swapped = {version: at for at, version in swaps}
+        delays = [swapped[version] - at for at, version in appended if version in swapped]
+        print('{} appends, {} swaps, {} of {} reads inconsistent'.format(len(appended), len(swaps), len(failures), len(latencies)))
+        print('final snapshot has {} rows, the manifest {}'.format(len(handle.current().dataset.dates), columnar.read_manifest(path)['rows']))
+        report('append to swap, mean (poll every {}s)'.format(args.interval), np.mean(delays) if delays else float('nan'))
+        report('read p50 during reloads', np.percentile(latencies, 50))
+        report('read max during reloads', np.max(latencies))
+        print('resident memory {:,} kB before the appends, {:,} kB after'.format(rss_before, resident_kb()))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def process_memory_kb(pid):
+
+    # Resident and proportional set size of one process. PSS splits shared pages between the processes mapping them,
+    # so it adds up to what a group of workers really costs (Linux)
+    memory = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+        for line in f:
+            field = line.split(':')[0]
+            if field in ('Rss', 'Pss'):
+                memory[field.lower()] = int(line.split()[1])
+
+    return memory
+
+
+def child_pids(pid):
+    with open('/proc/{0}/task/{0}/children'.format(pid)) as f:
+        return [int(child) for child in f.read().split()]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(n_workers, **env):
+
+    # covid_dash under gunicorn from this folder (so gunicorn.conf.py applies) on a free local port, once it answers.
+    # env adds to this process's environment, e.g. COVID_DATA_DIR
+    port = free_port()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'covid_dash:server', '--bind', '127.0.0.1:{}'.format(port)],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              env=dict(os.environ, WEB_CONCURRENCY=str(n_workers), PORT=str(port), **env),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    url = 'http://127.0.0.1:{}'.format(port)
+    deadline = time.time() + 300
+    while True:
+        try:
+            urlopen(url + '/_dash-layout', timeout=5).read()
+            return server, url
+        except OSError:
+            if time.time() > deadline or server.poll() is not None:
+                server.terminate()
+                raise RuntimeError('gunicorn did not start')
+            time.sleep(0.5)
+
+
+def bench_workers(args):
+
+    # Start gunicorn with and without preload, send every worker some chart callbacks, then add up the memory of the
+    # master and its workers. Fails when a preloaded worker costs more than --max-worker-ratio of a worker without it
+    rows = []
+    for preload in ('1', '0'):
+        for n_workers in args.workers:
+            aggregates_dir = tempfile.mkdtemp()
+            server, url = start_gunicorn(n_workers, COVID_PRELOAD=preload, COVID_AGGREGATES_DIR=aggregates_dir, COVID_DATA_DIR=args.data)
+            try:
+                # Concurrent clicks so the requests spread over the workers
+                dates = pd.DatetimeIndex(dataset.load_dataset(args.data).dates)
+                ranges = random_ranges(dates, n_workers * args.clicks * len(CHART_CALLBACKS), seed=2)
+
+                def click(i):
+                    tab, output_id, button_id, picker_id = CHART_CALLBACKS[i % len(CHART_CALLBACKS)]
+                    start, end = ranges[i]
+                    body = callback_body(output_id, 'figure', [(button_id, 'n_clicks', i)],
+                                         [(picker_id, 'start_date', start.strftime('%Y-%m-%d')),
+                                          (picker_id, 'end_date', end.strftime('%Y-%m-%d'))])
+                    request = Request(url + '/_dash-update-component', data=json.dumps(body).encode(),
+                                      headers={'Content-Type': 'application/json'})
+                    urlopen(request, timeout=120).read()
+
+                threads = [threading.Thread(target=lambda j=j: [click(i) for i in range(j, len(ranges), n_workers)])
+                           for j in range(n_workers)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+                workers = child_pids(server.pid)
+                master = process_memory_kb(server.pid)
+                memory = [process_memory_kb(pid) for pid in workers]
+                rows.append({'preload': preload == '1', 'workers': len(workers),
+                             'master_rss_mb': round(master['rss'] / 1024, 1),
+                             'worker_rss_mb': round(np.mean([m['rss'] for m in memory]) / 1024, 1),
+                             'worker_pss_mb': round(np.mean([m['pss'] for m in memory]) / 1024, 1),
+                             'total_pss_mb': round((master['pss'] + sum(m['pss'] for m in memory)) / 1024, 1)})
+            finally:
+                server.terminate()
+                server.wait()
+                shutil.rmtree(aggregates_dir)
+
+    results = pd.DataFrame(rows)
+    print(results.to_string(index=False))
+
+    # What one more worker costs, from the smallest and largest runs of each mode
+    per_worker = {}
+    for preload, runs in results.groupby('preload'):
+        runs = runs.sort_values('workers')
+        if len(runs) > 1 and runs['workers'].iloc[-1] > runs['workers'].iloc[0]:
+            per_worker[preload] = (runs['total_pss_mb'].iloc[-1] - runs['total_pss_mb'].iloc[0]) / (runs['workers'].iloc[-1] - runs['workers'].iloc[0])
+            print('{}: {:.1f} MB per additional worker'.format('preload' if preload else 'no preload', per_worker[preload]))
+
+    if len(per_worker) < 2:
+        print('preload check needs at least two --workers counts')
+        return 1
+
+    if per_worker[True] > per_worker[False] * args.max_worker_ratio:
+        print('a preloaded worker costs {:.2f}x a worker without preload, more than {}x'.format(per_worker[True] / per_worker[False], args.max_worker_ratio))
+        return 1
+
+    return 0
+
+
+def bench_instrument(args):
+
+    # The same Submit clicks with instrumentation off and then on, through Flask's test client, starting from an empty
+    # figure cache each time. Also shows what the Server-Timing header and /metrics carry
+    import covid_dash
+    import instrument
+
+    client = covid_dash.server.test_client()
+    ranges = random_ranges(pd.DatetimeIndex(covid_dash.datasets.current().dataset.dates), args.clicks * len(CHART_CALLBACKS), seed=3)
+    bodies = []
+    for i, (start, end) in enumerate(ranges):
+        tab, output_id, button_id, picker_id = CHART_CALLBACKS[i % len(CHART_CALLBACKS)]
+        bodies.append(callback_body(output_id, 'figure', [(button_id, 'n_clicks', i)],
+                                    [(picker_id, 'start_date', start.strftime('%Y-%m-%d')),
+                                     (picker_id, 'end_date', end.strftime('%Y-%m-%d'))]))
+
+    def clicks():
+        covid_dash.figure_cache.clear()
+        responses = []
+        start = time.perf_counter()
+        for body in bodies:
+            responses.append(client.post('/_dash-update-component', json=body))
+        return time.perf_counter() - start, responses
+
+    # Flask takes no new hooks once it has served a request, so they go in first and the off run has them bail out
+    if not instrument.ENABLED:
+        instrument.ENABLED = True
+        instrument.install(covid_dash.app, covid_dash.dashboard_metrics)
+    instrument.ENABLED = False
+    off, _ = min((clicks() for _ in range(args.repeat)), key=lambda run: run[0])
+    report('{} callbacks, instrumentation off'.format(len(bodies)), off)
+
+    instrument.ENABLED = True
+    on, responses = min((clicks() for _ in range(args.repeat)), key=lambda run: run[0])
+    report('{} callbacks, instrumentation on'.format(len(bodies)), on)
+
+    # What marking one phase costs, outside a request (and so with metrics off) and inside one with them on
+    def mark_phases(count=100000):
+        for _ in range(count):
+            with instrument.phase('build'):
+                pass
+    with covid_dash.server.test_request_context(instrument.CALLBACK_PATH):
+        flask.g.phases = {}
+        seconds, _ = timed(mark_phases)
+    report('100000 phases, metrics on', seconds)
+    instrument.ENABLED = False
+    seconds, _ = timed(mark_phases)
+    report('100000 phases, metrics off', seconds)
+
+    assert all('Server-Timing' in response.headers for response in responses)
+    print('Server-Timing: {}'.format(responses[0].headers['Server-Timing']))
+    metrics = client.get('/metrics').get_data(as_text=True)
+    print('\n'.join(line for line in metrics.splitlines() if line.startswith(('covid_callback_phase_seconds_total', 'covid_figure_cache_hits', 'covid_dataset_info'))))
+
+
+def bench_api(args):
+
+    # The data API through Flask's test client: response sizes per encoding and the cost of a computed answer
+    # against a 304. What the API has to answer is checked in test_api.py
+    import covid_dash
+    import api
+
+    client = covid_dash.server.test_client()
+    data = covid_dash.datasets.current()
+    ranges = random_ranges(pd.DatetimeIndex(data.dataset.dates), args.queries, seed=4)
+
+    def url(start, end, extra=''):
+        return '/api/v1/aggregates?start={:%Y-%m-%d}&end={:%Y-%m-%d}{}'.format(start, end, extra)
+
+    # Bytes on the wire for one range
+    start, end = ranges[0]
+    plain = client.get(url(start, end), headers={'Accept-Encoding': 'identity'})
+    for encoding in ('gzip', 'br'):
+        response = client.get(url(start, end), headers={'Accept-Encoding': encoding})
+        print('{:<8} {:>8,} bytes, {:>8,} identity'.format(encoding, len(response.data), len(plain.data)))
+
+    if api.pa is not None:
+        response = client.get(url(start, end, '&format=arrow'), headers={'Accept-Encoding': 'identity'})
+        print('arrow    {:>8,} bytes'.format(len(response.data)))
+
+    # Every range computed once, then revalidated
+    etags = []
+    start_time = time.perf_counter()
+    for start, end in ranges:
+        etags.append(client.get(url(start, end)).headers['ETag'])
+    computed = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    for (start, end), etag in zip(ranges, etags):
+        assert client.get(url(start, end), headers={'If-None-Match': etag}).status_code == 304
+    revalidated = time.perf_counter() - start_time
+    report('{} ranges, computed'.format(len(ranges)), computed)
+    report('{} ranges, 304 revalidation'.format(len(ranges)), revalidated)
+
+
+def write_synthetic_dataset(path, years, n_districts, seed=0):
+
+    # A synthetic dataset on disk in the scrape's columnar format, for a dashboard started with COVID_DATA_DIR
+    import columnar
+    import metrics
+
+    data = synthetic_dataset(years, n_districts, seed)
+    arrays = dict(data.arrays)
+    population = data.arrays['daily_cases'].sum(axis=0) / data.arrays['incidence'].sum(axis=0) * 100000
+    arrays.update(metrics.compute_metrics(arrays['daily_cases'], population))
+
+    return columnar.write_dataset(path, data.dates, data.districts, arrays)
+
+
+def find_props(layout, component_id):
+
+    # Properties of the component with this id somewhere in a serialized Dash layout
+    if isinstance(layout, dict):
+        if layout.get('props', {}).get('id') == component_id:
+            return layout['props']
+        children = list(layout.values())
+    elif isinstance(layout, list):
+        children = layout
+    else:
+        return None
+
+    for child in children:
+        props = find_props(child, component_id)
+        if props is not None:
+            return props
+
+    return None
+
+
+def load_session(url, ranges, args, stop, records, seed=0):
+
+    # One visitor: load the page, then until told to stop open a random chart tab, let its chart draw for the
+    # default dates and submit a few random ranges. records gets (request, seconds, ok) for every request
+    rng = np.random.default_rng(seed)
+
+    def request(name, path, body=None):
+        start = time.perf_counter()
+        try:
+            data = None if body is None else json.dumps(body).encode()
+            with urlopen(Request(url + path, data=data, headers={'Content-Type': 'application/json'}), timeout=args.timeout) as response:
+                payload = response.read()
+                ok = response.status in (200, 204)
+        except OSError:
+            payload, ok = None, False
+        records.append((name, time.perf_counter() - start, ok))
+        return payload
+
+    for path in ('/', '/_dash-layout', '/_dash-dependencies'):
+        request(path, path)
+
+    clicks = 0
+    while not stop.is_set():
+        tab, output_id, button_id, picker_id = CHART_CALLBACKS[rng.integers(len(CHART_CALLBACKS))]
+        payload = request('render_content', '/_dash-update-component',
+                          callback_body('dash-tabs-content', 'children', [('dash-tabs', 'value', tab)]))
+
+        # The chart draws as soon as the tab is shown, with the dates the picker opens on
+        picker = find_props(json.loads(payload), picker_id) if payload else None
+        if picker is None:
+            continue
+        dates = [(picker['start_date'], picker['end_date'])]
+        dates += [(start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')) for start, end in
+                  (ranges[i] for i in rng.integers(len(ranges), size=args.clicks))]
+
+        for n_clicks, (start, end) in enumerate(dates):
+            if stop.is_set():
+                break
+            request(output_id, '/_dash-update-component',
+                    callback_body(output_id, 'figure', [(button_id, 'n_clicks', clicks + n_clicks)],
+                                  [(picker_id, 'start_date', start), (picker_id, 'end_date', end)]))
+            if args.think:
+                stop.wait(rng.exponential(args.think))
+        clicks += len(dates)
+
+
+def bench_load(args):
+
+    # Concurrent visitors against covid_dash under gunicorn, for every dataset size and concurrency level.
+    # Reports per-callback latency percentiles, error rate and throughput. With --compare it fails when p95
+    # latency regressed past the tolerance, and with --max-error-rate when too many requests failed
+    rows = []
+    for n_districts in args.districts:
+        for years in args.years:
+            workdir = tempfile.mkdtemp()
+            try:
+                path = os.path.join(workdir, 'data')
+                write_synthetic_dataset(path, years, n_districts)
+                ranges = random_ranges(pd.DatetimeIndex(dataset.open_dataset(path).dates), 1000, seed=5)
+
+                for n_workers in args.load_workers:
+                    server, url = start_gunicorn(n_workers, COVID_DATA_DIR=path, COVID_AGGREGATES_DIR=os.path.join(workdir, 'aggregates'),
+                                                 COVID_FIGURE_CACHE_DIR='', COVID_RELOAD_SECONDS='0')
+                    try:
+                        for concurrency in args.concurrency:
+                            stop = threading.Event()
+                            records = []
+                            sessions = [threading.Thread(target=load_session, args=(url, ranges, args, stop, records, i))
+                                        for i in range(concurrency)]
+                            start = time.perf_counter()
+                            for session in sessions:
+                                session.start()
+                            time.sleep(args.duration)
+                            stop.set()
+                            for session in sessions:
+                                session.join()
+                            elapsed = time.perf_counter() - start
+
+                            frame = pd.DataFrame(records, columns=['request', 'seconds', 'ok'])
+                            callbacks = frame[frame['request'].isin(['render_content'] + [output for tab, output, button, picker in CHART_CALLBACKS])]
+                            for name, group in list(callbacks.groupby('request', sort=True)) + [('all callbacks', callbacks)]:
+                                timings = group.loc[group['ok'], 'seconds'] * 1000
+                                percentiles = np.percentile(timings, [50, 95, 99]) if len(timings) else [np.nan] * 3
+                                rows.append({'callback': name, 'districts': n_districts, 'years': years, 'workers': n_workers,
+                                             'concurrency': concurrency, 'requests': len(group), 'rps': round(len(group) / elapsed, 2),
+                                             'p50_ms': round(percentiles[0], 1), 'p95_ms': round(percentiles[1], 1), 'p99_ms': round(percentiles[2], 1),
+                                             'errors': int((~group['ok']).sum()), 'error_rate': round(float((~group['ok']).mean()), 4)})
+                    finally:
+                        server.terminate()
+                        server.wait()
+            finally:
+                shutil.rmtree(workdir)
+
+    failed = results_table(rows, args, metric='p95_ms')
+
+    totals = pd.DataFrame(rows)
+    totals = totals[totals['callback'] == 'all callbacks']
+    too_many_errors = totals[totals['error_rate'] > args.max_error_rate]
+    if len(too_many_errors):
+        print('error rate above {}:'.format(args.max_error_rate))
+        print(too_many_errors[['districts', 'years', 'workers', 'concurrency', 'error_rate']].to_string(index=False))
+        failed = 1
+
+    return failed
+
+
+SECTIONS = {'geometry': bench_geometry,
+            'aggregates': bench_aggregates,
+            'startup': bench_startup,
+            'box': bench_box,
+            'bars': bench_bars,
+            'session': bench_session,
+            'callbacks': bench_callbacks,
+            'reload': bench_reload,
+            'workers': bench_workers,
+            'instrument': bench_instrument,
+            'api': bench_api,
+            'load': bench_load}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Berlin covid dashboard')
+    parser.add_argument('section', choices=sorted(SECTIONS))
+    parser.add_argument('--geojson', default=geometry.GEOJSON_PATH, help='district GeoJSON file')
+    parser.add_argument('--incidence', default=os.path.join(SCRAPE_DIR, 'incidence.csv'), help='incidence CSV')
+    parser.add_argument('--data', default=dataset.DATA_DIR, help='columnar dataset directory')
+    parser.add_argument('--bar-points', type=int, default=4000, help='bar budget for the rolling average chart')
+    parser.add_argument('--clicks', type=int, default=5, help='Submit clicks per chart in a session')
+    parser.add_argument('--queries', type=int, default=200, help='number of random date ranges')
+    parser.add_argument('--districts', type=int, nargs='+', default=[12, 100, 400], help='region counts for the callbacks benchmark')
+    parser.add_argument('--years', type=float, nargs='+', default=[1, 5, 10], help='history lengths for the callbacks benchmark')
+    parser.add_argument('--interval', type=float, default=0.1, help='seconds between manifest checks for the reload benchmark')
+    parser.add_argument('--appends', type=int, default=20, help='days appended during the reload benchmark')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='gunicorn worker counts for the workers benchmark')
+    parser.add_argument('--max-worker-ratio', type=float, default=0.5, help='largest PSS of an additional preloaded worker, as a share of one without preload')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16], help='simultaneous sessions for the load test')
+    parser.add_argument('--duration', type=float, default=20, help='seconds each load test level runs for')
+    parser.add_argument('--load-workers', type=int, nargs='+', default=[2], help='gunicorn workers for the load test')
+    parser.add_argument('--think', type=float, default=0, help='mean seconds a load test session waits between clicks')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds before a load test request counts as failed')
+    parser.add_argument('--max-error-rate', type=float, default=0.01, help='failed request share that fails the load test')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per timing, the best one counts')
+    parser.add_argument('--save', help='write the results to this CSV')
+    parser.add_argument('--compare', help='baseline CSV to check the results against')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='slowdown against the baseline that counts as a regression')
+    args = parser.parse_args(argv)
+
+    return SECTIONS[args.section](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+import warnings
+
+import numpy as np
+import plotly.graph_objs as go
+
+# Box plot statistics computed on the server, so the figure carries a handful of numbers per district
+# instead of every daily observation.
+
+
+def quantiles(values, count, p):
+
+    # Quantile p of every column the way plotly.js computes box quartiles (quartilemethod 'linear'): position
+    # n * p - 0.5 in the sorted non-NaN values, clamped to the first and last value, interpolating in between.
+    # numpy's default puts it at (n - 1) * p instead, which moves the quartiles of short ranges
+    ordered = np.sort(values, axis=0)
+    position = np.clip(count * p - 0.5, 0, np.maximum(count - 1, 0))
+    below = np.floor(position).astype(int)
+    above = np.ceil(position).astype(int)
+    fraction = position - below
+
+    low = np.take_along_axis(ordered, below[np.newaxis], axis=0)[0]
+    high = np.take_along_axis(ordered, above[np.newaxis], axis=0)[0]
+
+    return np.where(count > 0, low + fraction * (high - low), np.nan)
+
+
+def box_stats(values):
+
+    # values is a dates x districts matrix with NaN for missing days. Everything is computed down the date axis
+    # for all districts at once
+    values = np.asarray(values, dtype=float)
+    count = np.sum(~np.isnan(values), axis=0)
+
+    # No dates in the range (an empty or reversed range, or one outside the data): every district has a zero count,
+    # so box_figure draws nothing
+    if values.shape[0] == 0:
+        empty = np.full(values.shape[1], np.nan)
+        return {'count': count, 'q1': empty, 'median': empty, 'q3': empty,
+                'lowerfence': empty, 'upperfence': empty, 'notchspan': empty,
+                'outliers': [values[:, i] for i in range(values.shape[1])]}
+
+    # Districts without data in the range come out as NaN. numpy warns about those All-NaN slices through the
+    # warnings module, which errstate doesn't cover
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        q1, median, q3 = (quantiles(values, count, p) for p in (0.25, 0.5, 0.75))
+        iqr = q3 - q1
+
+        # Whiskers end at the furthest observations still within 1.5 IQR of the box
+        inside = (values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)
+        lowerfence = np.nanmin(np.where(inside, values, np.nan), axis=0)
+        upperfence = np.nanmax(np.where(inside, values, np.nan), axis=0)
+
+        # Notches span median +/- 1.57 IQR / sqrt(n)
+        notchspan = 1.57 * iqr / np.sqrt(count)
+
+    outliers = ~inside & ~np.isnan(values)
+
+    return {'count': count, 'q1': q1, 'median': median, 'q3': q3,
+            'lowerfence': lowerfence, 'upperfence': upperfence, 'notchspan': notchspan,
+            'outliers': [values[outliers[:, i], i] for i in range(values.shape[1])]}
+
+
+def sample_points(values, max_points, seed=0):
+
+    # Evenly thinned points for the optional overlay, at most max_points per district
+    values = values[~np.isnan(values)]
+    if len(values) <= max_points:
+        return values
+
+    return values[np.linspace(0, len(values) - 1, max_points).round().astype(int)]
+
+
+def box_figure(values, districts, colors, max_points=0, stats=None):
+
+    # Statistics can be passed in when they were already computed
+    stats = box_stats(values) if stats is None else stats
+    fig = go.Figure()
+
+    for i, district in enumerate(districts):
+        if stats['count'][i] == 0:
+            continue
+        color = colors[i % len(colors)]
+
+        # One horizontal box per district from the precomputed statistics
+        fig.add_trace(go.Box(name=district,
+                             y=[district],
+                             q1=[stats['q1'][i]],
+                             median=[stats['median'][i]],
+                             q3=[stats['q3'][i]],
+                             lowerfence=[stats['lowerfence'][i]],
+                             upperfence=[stats['upperfence'][i]],
+                             notchspan=[stats['notchspan'][i]],
+                             notched=True,
+                             orientation='h',
+                             marker_color=color,
+                             legendgroup=district))
+
+        # Outliers still have to be drawn as points, plus a capped sample of the rest if asked for
+        points = stats['outliers'][i]
+        if max_points:
+            points = np.concatenate([points, sample_points(values[:, i], max_points)])
+        if len(points):
+            fig.add_trace(go.Scatter(x=points,
+                                     y=[district] * len(points),
+                                     mode='markers',
+                                     marker=dict(color=color, size=4, opacity=0.6),
+                                     name=district,
+                                     legendgroup=district,
+                                     showlegend=False))
+
+    fig.update_layout(xaxis_title='Incidence', yaxis_title='District')
+
+    return fig
@@ -0,0 +1,37 @@
+import numpy as np
+
+import geometry
+
+# Compact copy of the dataset for the browser. With it in a dcc.Store, date filtering and aggregation for all four
+# charts run in assets/clientside.js and Submit clicks never reach the server.
+
+# Decimal places kept for the float columns, enough for what the charts show
+DECIMALS = 3
+
+
+def encode_column(values):
+
+    # One list per district, NaN sent as null
+    values = np.round(np.asarray(values, dtype=float), DECIMALS).T
+
+    return [[None if np.isnan(value) else value for value in column] for column in values.tolist()]
+
+
+def compact_dataset(dataset, colors, bar_points, map_width, map_height):
+
+    # Dates go as day offsets from the first date and districts by position in the district list
+    days = np.asarray(dataset.dates, dtype='datetime64[D]')
+    offsets = (days - days[0]).astype(np.int64) if len(days) else np.array([], dtype=np.int64)
+
+    return {'version': dataset.version,
+            'start': str(days[0]) if len(days) else None,
+            'days': offsets.tolist(),
+            'districts': list(dataset.districts),
+            'rolling_cases': encode_column(dataset.arrays['rolling_cases']),
+            'daily_cases': encode_column(dataset.arrays['daily_cases']),
+            'incidence': encode_column(dataset.arrays['incidence']),
+            'bar_points': bar_points,
+            'colors': colors,
+            'map': {'geojson': geometry.geometry_for_viewport(map_width, map_height),
+                    'featureidkey': 'properties.' + geometry.FEATURE_KEY,
+                    'height': map_height}}
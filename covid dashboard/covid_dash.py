@@ -1,31 +1,85 @@
 import pandas as pd
 import numpy as np
 from datetime import datetime
+import os
+from functools import lru_cache
 
 import plotly.express as px
 import plotly.offline as pyo
 import plotly.graph_objs as go
 
+import flask
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
-
-from urllib.request import urlopen
-import json # library to handle JSON files
-from pandas.io.json import json_normalize # tranform JSON file into a pandas dataframe
-
-from geojson_rewind import rewind
-
-# Read in data that we scraped and created
-rolling_7_long = pd.read_csv('https://raw.githubusercontent.com/hrishipoola/berlin_covid_dashboard/main/covid%20scrape/rolling_7_long.csv', parse_dates=['Date'], index_col='Date')
-incidence = pd.read_csv('https://raw.githubusercontent.com/hrishipoola/berlin_covid_dashboard/main/covid%20scrape/incidence.csv', parse_dates=['Date'], index_col='Date')
+from dash.dependencies import Input, Output, State, ClientsideFunction
+
+import geometry
+from dataset import melt, INCIDENCE_COLUMNS
+from datahandle import DatasetHandle
+from boxstats import box_figure, box_stats
+from downsample import choose_bucket, bucket_means, BUCKET_TITLES
+from clientside import compact_dataset
+from figcache import FigureCache
+import instrument
+import api
+from instrument import phase
+
+# Compute box plot statistics on the server ('server') or ship every point and let plotly do it ('client')
+BOX_MODE = os.environ.get('COVID_BOX_MODE', 'server')
+
+# Cap on sampled points drawn per district next to the server-side boxes. 0 draws only the outliers
+BOX_POINTS = int(os.environ.get('COVID_BOX_POINTS', 0))
+
+# Most bars (dates x districts) the rolling average chart draws before switching to weekly, then monthly, averages
+BAR_POINTS = int(os.environ.get('COVID_BAR_POINTS', 4000))
+
+# Send the data to the browser once and filter/aggregate there instead of calling the server on every Submit
+CLIENTSIDE = os.environ.get('COVID_CLIENTSIDE', '0') == '1'
+
+BAR_COLORS = ['rgb(27,158,119)', 'rgb(217,95,2)', 'rgb(117,112,179)', 'rgb(231,41,138)', 'rgb(102,166,30)', 'rgb(230,171,2)',
+              'rgb(166,118,29)', 'rgb(102,102,102)', '#1CA71C','#2E91E5','#778AAE','#E15F99']
+
+# Date picker bounds and the ranges each tab opens on
+FIRST_DATE = datetime(2020,3,9)
+LAST_DATE = datetime(2020,12,15)
+RECENT_START = datetime(2020,11,11)
+
+# Figure cache limits, and a directory to share cached figures between workers (off when unset) with its own size limit
+FIGURE_CACHE_ENTRIES = int(os.environ.get('COVID_FIGURE_CACHE_ENTRIES', 256))
+FIGURE_CACHE_MB = int(os.environ.get('COVID_FIGURE_CACHE_MB', 64))
+FIGURE_CACHE_DIR = os.environ.get('COVID_FIGURE_CACHE_DIR')
+FIGURE_CACHE_DIR_MB = int(os.environ.get('COVID_FIGURE_CACHE_DIR_MB', 256))
+
+# Nominal map size used to pick the geometry simplification level
+MAP_WIDTH = 1250
+MAP_HEIGHT = 450
+
+# Memory-map the data that we scraped and created, with running totals of cases and incidence by district so range
+# averages don't have to filter and group the whole table. Charts slice it by date on request, and new scrapes are
+# swapped in by a background thread (every COVID_RELOAD_SECONDS)
+datasets = DatasetHandle()
+
+# Serialized figures by chart, date range and dataset version
+figure_cache = FigureCache(max_entries=FIGURE_CACHE_ENTRIES,
+                           max_bytes=FIGURE_CACHE_MB * 1024 * 1024,
+                           directory=FIGURE_CACHE_DIR,
+                           max_disk_bytes=FIGURE_CACHE_DIR_MB * 1024 * 1024,
+                           version=lambda: datasets.current().version)
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
-app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+# Responses are compressed by Flask-Compress: brotli for clients that take it, gzip otherwise, and Arrow responses from
+# the data API as well as the text ones. It reads its settings when Dash sets it up, so the server is configured first
+server = flask.Flask(__name__)
+server.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+server.config['COMPRESS_MIMETYPES'] = ['text/html', 'text/css', 'text/plain', 'text/xml', 'application/json',
+                                       'application/javascript', api.ARROW_MIMETYPE]
 
-server = app.server
+app = dash.Dash(__name__, server=server, external_stylesheets=external_stylesheets, compress=True)
+
+# Load, simplify and rewind the district polygons once at startup instead of on every map request
+geometry.load_levels()
 
 markdown_text = '''
 ## Berlin Covid Dashboard
@@ -66,18 +120,40 @@ than that indicated by confirmed positive tests.
 If you want to learn more, give us a shout at info@crawstat.com!
 '''
 
-app.layout = html.Div([
-    dcc.Tabs(id='dash-tabs', value='tab-1', children=[
-        dcc.Tab(label='Berlin Covid Dashboard', value='tab-1'),
-        dcc.Tab(label='Rolling 7-Day Average Cases', value='tab-2'),
-        dcc.Tab(label='Daily Incidence Statistical Spread', value='tab-3'),
-        dcc.Tab(label='Average Daily Incidence', value='tab-4'),
-        dcc.Tab(label='Map', value='tab-5')
-    ], colors={'border': 'white',
-               'primary': 'darkturquoise',
-               'background': 'whitesmoke'}),
-    html.Div(id='dash-tabs-content')
-])
+# Compact copy of one dataset version for the browser, built once per version
+@lru_cache(maxsize=1)
+def dataset_store(data):
+    return compact_dataset(data.dataset,
+                           {'bar': BAR_COLORS, 'box': px.colors.qualitative.Set2, 'map': px.colors.cmocean.deep},
+                           BAR_POINTS, MAP_WIDTH, MAP_HEIGHT)
+
+# Date pickers reach as far as the data we have
+def max_date():
+    return max(LAST_DATE, pd.Timestamp(datasets.current().dataset.dates[-1]).to_pydatetime())
+
+# The layout is built per page load so the browser gets the current dataset
+def serve_layout():
+    return html.Div([
+        dcc.Tabs(id='dash-tabs', value='tab-1', children=[
+            dcc.Tab(label='Berlin Covid Dashboard', value='tab-1'),
+            dcc.Tab(label='Rolling 7-Day Average Cases', value='tab-2'),
+            dcc.Tab(label='Daily Incidence Statistical Spread', value='tab-3'),
+            dcc.Tab(label='Average Daily Incidence', value='tab-4'),
+            dcc.Tab(label='Map', value='tab-5')
+        ], colors={'border': 'white',
+                   'primary': 'darkturquoise',
+                   'background': 'whitesmoke'}),
+        html.Div(id='dash-tabs-content')
+    ] + ([dcc.Store(id='dataset-store', data=dataset_store(datasets.current()))] if CLIENTSIDE else []))
+
+app.layout = serve_layout
+
+# Chart callbacks only run on the server when they aren't handled in the browser
+if CLIENTSIDE:
+    def server_callback(*args, **kwargs):
+        return lambda function: function
+else:
+    server_callback = app.callback
 
 @app.callback(Output('dash-tabs-content', 'children'),
               Input('dash-tabs', 'value'))
@@ -94,10 +170,10 @@ def render_content(tab):
                      html.Div([
                                html.H6('Select start and end dates:'),
                                dcc.DatePickerRange(id='date_picker1',
-                                                   min_date_allowed=datetime(2020,3,9),
-                                                   max_date_allowed=datetime(2020,12,15),
-                                                   start_date=datetime(2020,3,9),
-                                                   end_date=datetime(2020,12,15),
+                                                   min_date_allowed=FIRST_DATE,
+                                                   max_date_allowed=max_date(),
+                                                   start_date=FIRST_DATE,
+                                                   end_date=LAST_DATE,
                                                    display_format='MMM D, YYYY')
                               ],style={'display':'inline-block',
                                        'verticalAlign':'top',
@@ -122,10 +198,10 @@ def render_content(tab):
                      html.Div([
                                html.H6('Select start and end dates:'),
                                dcc.DatePickerRange(id='date_picker2',
-                                                   min_date_allowed=datetime(2020,3,9),
-                                                   max_date_allowed=datetime(2020,12,15),
-                                                   start_date=datetime(2020,3,9),
-                                                   end_date=datetime(2020,12,15),
+                                                   min_date_allowed=FIRST_DATE,
+                                                   max_date_allowed=max_date(),
+                                                   start_date=FIRST_DATE,
+                                                   end_date=LAST_DATE,
                                                    display_format='MMM D, YYYY')
                               ],style={'display':'inline-block','verticalAlign':'top','width':'30%', 'vertical':'40%'}),
                      html.Div([
@@ -145,10 +221,10 @@ def render_content(tab):
                     html.Div([
                             html.H6('Select start and end dates:'),
                             dcc.DatePickerRange(id='date_picker3',
-                                                min_date_allowed=datetime(2020,3,9),
-                                                max_date_allowed=datetime(2020,12,15),
-                                                start_date=datetime(2020,11,11),
-                                                end_date=datetime(2020,12,15),
+                                                min_date_allowed=FIRST_DATE,
+                                                max_date_allowed=max_date(),
+                                                start_date=RECENT_START,
+                                                end_date=LAST_DATE,
                                                 display_format='MMM D, YYYY')
                                 ],style={'display':'inline-block','verticalAlign':'top','width':'30%', 'vertical':'40%'}),
                     html.Div([
@@ -168,10 +244,10 @@ def render_content(tab):
                     html.Div([
                             html.H6('Select start and end dates:'),
                             dcc.DatePickerRange(id='date_picker4',
-                                                min_date_allowed=datetime(2020,3,9),
-                                                max_date_allowed=datetime(2020,12,15),
-                                                start_date=datetime(2020,11,11),
-                                                end_date=datetime(2020,12,15),
+                                                min_date_allowed=FIRST_DATE,
+                                                max_date_allowed=max_date(),
+                                                start_date=RECENT_START,
+                                                end_date=LAST_DATE,
                                                 display_format='MMM D, YYYY')
                                 ],style={'display':'inline-block','verticalAlign':'top','width':'30%', 'vertical':'40%'}),
                     html.Div([
@@ -188,7 +264,35 @@ def render_content(tab):
 
 # Tab 2 callback
 
-@app.callback(Output('bar_graph', 'figure'),
+@figure_cache.cached('bar_graph', variant=lambda: BAR_POINTS)
+def bar_figure(data, start, end):
+    dataset = data.dataset
+    with phase('filter'):
+        lo, hi = dataset.rows(start, end)
+        dates = dataset.dates[lo:hi]
+
+    # Average into coarser time buckets when the range has more bars than we want to send
+    with phase('aggregate'):
+        bucket = choose_bucket(dates, len(dataset.districts), BAR_POINTS)
+        bucket_dates, cases = bucket_means(dates, dataset.arrays['rolling_cases'][lo:hi], bucket)
+
+    with phase('filter'):
+        filtered_df = melt(bucket_dates, dataset.districts, {'Cases': cases})
+
+    with phase('build'):
+        fig1 = px.bar(filtered_df,
+                     x=filtered_df.index,
+                     y='Cases',
+                     color='District',
+                     color_discrete_sequence=BAR_COLORS,
+                     width=1250,
+                     height=475)
+
+        fig1.update_layout(hovermode='closest', xaxis_title=BUCKET_TITLES[bucket])
+
+    return fig1
+
+@server_callback(Output('bar_graph', 'figure'),
              [Input('submit-button1','n_clicks')],
              [State('date_picker1','start_date'),
               State('date_picker1','end_date')])
@@ -197,24 +301,49 @@ def update_bar_graph(n_clicks, start_date, end_date):
     start = datetime.strptime(start_date[:10], '%Y-%m-%d')
     end = datetime.strptime(end_date[:10], '%Y-%m-%d')
 
-    filtered_df = rolling_7_long[(rolling_7_long.index >= start) & (rolling_7_long.index <= end)]
+    return bar_figure(datasets.current(), start, end)
 
-    fig1 = px.bar(filtered_df,
-                 x=filtered_df.index,
-                 y='Cases',
-                 color='District',
-                 color_discrete_sequence=['rgb(27,158,119)', 'rgb(217,95,2)', 'rgb(117,112,179)', 'rgb(231,41,138)', 'rgb(102,166,30)', 'rgb(230,171,2)',
-                                          'rgb(166,118,29)', 'rgb(102,102,102)', '#1CA71C','#2E91E5','#778AAE','#E15F99'],
-                 width=1250,
-                 height=475)
+# Tab 3 callback
 
-    fig1.update_layout(hovermode='closest')
+@figure_cache.cached('box_graph', variant=lambda: '{}-{}'.format(BOX_MODE, BOX_POINTS))
+def box_spread_figure(data, start, end):
+    dataset = data.dataset
+    if BOX_MODE == 'server':
+        with phase('filter'):
+            values = dataset.window('incidence', start, end)
+
+        # Quartiles, fences, notches and outliers for every district in one pass over the incidence matrix
+        with phase('aggregate'):
+            stats = box_stats(values)
+
+        with phase('build'):
+            fig2 = box_figure(values,
+                              dataset.districts,
+                              px.colors.qualitative.Set2,
+                              max_points=BOX_POINTS,
+                              stats=stats)
+            fig2.update_layout(width=1250, height=475, legend_title_text='District')
+
+    else:
+        with phase('filter'):
+            filtered_df = dataset.long_frame(INCIDENCE_COLUMNS, start, end)
+
+        with phase('build'):
+            fig2 = px.box(filtered_df,
+                     x='Incidence',
+                     y='District',
+                     color='District',
+                     points='all',
+                     notched=True,
+                     color_discrete_sequence=px.colors.qualitative.Set2,
+                     width=1250,
+                     height=475)
 
-    return fig1
+    fig2.update_layout(hovermode='closest')
 
-# Tab 3 callback
+    return fig2
 
-@app.callback(Output('box_graph', 'figure'),
+@server_callback(Output('box_graph', 'figure'),
              [Input('submit-button2','n_clicks')],
              [State('date_picker2','start_date'),
               State('date_picker2','end_date')])
@@ -223,25 +352,29 @@ def update_box_graph(n_clicks, start_date, end_date):
     start = datetime.strptime(start_date[:10], '%Y-%m-%d')
     end = datetime.strptime(end_date[:10], '%Y-%m-%d')
 
-    filtered_df = incidence[(incidence.index >= start) & (incidence.index <= end)]
+    return box_spread_figure(datasets.current(), start, end)
 
-    fig2 = px.box(filtered_df,
-             x='Incidence',
-             y='District',
-             color='District',
-             points='all',
-             notched=True,
-             color_discrete_sequence=px.colors.qualitative.Set2,
-             width=1250,
-             height=475)
+# Tab 4 callback
 
-    fig2.update_layout(hovermode='closest')
+@figure_cache.cached('bar_graph_incidence')
+def incidence_bar_figure(data, start, end):
+    # Create districts dataframe with mean numbers by district over the range, sort
+    with phase('aggregate'):
+        districts = data.incidence_aggregates.mean(start, end).sort_values(by='Incidence')
 
-    return fig2
+    # Plotly express plot
+    with phase('build'):
+        fig3 = px.bar(districts,
+                     x='Incidence',
+                     y=districts.index,
+                     #title='Average 7-Day Incidence by District',
+                     color_discrete_sequence=['darkturquoise'],
+                     width = 1250,
+                     height=475)
 
-# Tab 4 callback
+    return fig3
 
-@app.callback(Output('bar_graph_incidence', 'figure'),
+@server_callback(Output('bar_graph_incidence', 'figure'),
              [Input('submit-button3','n_clicks')],
              [State('date_picker3','start_date'),
               State('date_picker3','end_date')])
@@ -250,25 +383,40 @@ def update_bar_graph_incidence(n_clicks, start_date, end_date):
     start = datetime.strptime(start_date[:10], '%Y-%m-%d')
     end = datetime.strptime(end_date[:10], '%Y-%m-%d')
 
-    filtered_df = incidence[(incidence.index >= start) & (incidence.index <= end)]
+    return incidence_bar_figure(datasets.current(), start, end)
 
-    # Create districts dataframe, group mean numbers by district, sort
-    districts = filtered_df.groupby(['District']).mean().sort_values(by='Incidence')
+# Tab 5 callback
 
-    # Plotly express plot
-    fig3 = px.bar(districts,
-                 x='Incidence',
-                 y=districts.index,
-                 #title='Average 7-Day Incidence by District',
-                 color_discrete_sequence=['darkturquoise'],
-                 width = 1250,
-                 height=475)
+@figure_cache.cached('incidence_map', variant=geometry.cache_variant)
+def incidence_map_figure(data, start, end):
+    # Create districts dataframe with mean numbers by district over the range, sort
+    with phase('aggregate'):
+        districts = data.incidence_aggregates.mean(start, end).sort_values(by='Incidence')
 
-    return fig3
+        # Reset index
+        districts.reset_index(inplace=True)
 
-# Tab 5 callback
+    # Pre-rewound district polygons simplified to what the map can actually show
+    districts_rewound = geometry.geometry_for_viewport(MAP_WIDTH, MAP_HEIGHT)
+
+    with phase('build'):
+        fig4 = px.choropleth(districts,
+                            geojson=districts_rewound,
+                            locations='District',
+                            color='Incidence',
+                            color_continuous_scale='Deep',
+                            featureidkey='properties.Gemeinde_name',
+                            projection="mercator",
+                            )
 
-@app.callback(Output('incidence_map', 'figure'),
+        fig4.update_geos(fitbounds='locations', visible=False)
+
+        fig4.update_layout(height=MAP_HEIGHT)
+        fig4.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
+
+    return fig4
+
+@server_callback(Output('incidence_map', 'figure'),
              [Input('submit-button4','n_clicks')],
              [State('date_picker4','start_date'),
               State('date_picker4','end_date')])
@@ -277,39 +425,63 @@ def incidence_map(n_clicks, start_date, end_date):
     start = datetime.strptime(start_date[:10], '%Y-%m-%d')
     end = datetime.strptime(end_date[:10], '%Y-%m-%d')
 
-    filtered_df = incidence[(incidence.index >= start) & (incidence.index <= end)]
-
-    # Create districts dataframe, group mean numbers by district, sort
-    districts = filtered_df.groupby(['District']).mean().sort_values(by='Incidence')
-
-    # Reset index
-    districts.reset_index(inplace=True)
-
-    # Load geojson for belin districts
-    with urlopen('https://raw.githubusercontent.com/pape1412/airbnb/master/data/berlin_neighbourhood_groups.geojson') as response:
-        berlin_districts = json.load(response)
-
-    # Check the property key that we need to match - it's Gemeinde_name
-    berlin_districts['features'][0]['properties']
-
-    # Rewind geojson to create map
-    districts_rewound = rewind(berlin_districts,rfc7946=False)
-
-    fig4 = px.choropleth(districts,
-                        geojson=districts_rewound,
-                        locations='District',
-                        color='Incidence',
-                        color_continuous_scale='Deep',
-                        featureidkey='properties.Gemeinde_name',
-                        projection="mercator",
-                        )
-
-    fig4.update_geos(fitbounds='locations', visible=False)
-
-    fig4.update_layout(height=450)
-    fig4.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
-
-    return fig4
-
+    return incidence_map_figure(datasets.current(), start, end)
+
+# Build the figures every tab opens on before the first visitor asks for them
+def prewarm_figure_cache(data):
+    figure_cache.prune_directory()
+    for build, start, end in [(bar_figure, FIRST_DATE, LAST_DATE),
+                              (box_spread_figure, FIRST_DATE, LAST_DATE),
+                              (incidence_bar_figure, RECENT_START, LAST_DATE),
+                              (incidence_map_figure, RECENT_START, LAST_DATE)]:
+        build(data, start, end)
+
+# When a new dataset is swapped in, figures of the old one are dropped and the defaults rebuilt, still on the reload thread
+def dataset_swapped(data):
+    figure_cache.clear()
+    if not CLIENTSIDE:
+        prewarm_figure_cache(data)
+
+datasets.listeners.append(dataset_swapped)
+
+# Hit, miss and eviction counters for tuning the cache
+@server.route('/_figure-cache')
+def figure_cache_stats():
+    return figure_cache.stats()
+
+# Figure cache and dataset figures next to the callback timings on /metrics
+def dashboard_metrics():
+    stats = figure_cache.stats()
+    return [('covid_figure_cache_{}_total'.format(counter), 'counter', 'Figure cache {}'.format(counter.replace('_', ' ')), stats[counter], {})
+            for counter in ('hits', 'disk_hits', 'misses', 'evictions')] + \
+           [('covid_figure_cache_entries', 'gauge', 'Figures in the in-memory cache', stats['entries'], {}),
+            ('covid_figure_cache_bytes', 'gauge', 'Bytes of figures in the in-memory cache', stats['bytes'], {}),
+            ('covid_dataset_info', 'gauge', 'Dataset version being served', 1, {'version': datasets.current().version})]
+
+# Read-only JSON/Arrow range aggregates for other consumers of the data, at /api/v1
+api.install(server, datasets)
+
+# Per-callback phase timings, Server-Timing headers and /metrics when COVID_METRICS=1
+instrument.install(app, dashboard_metrics)
+
+# Browser-side versions of the chart callbacks, in assets/clientside.js
+if CLIENTSIDE:
+    for figure_id, function_name, button_id, picker_id in [('bar_graph', 'bar', 'submit-button1', 'date_picker1'),
+                                                            ('box_graph', 'box', 'submit-button2', 'date_picker2'),
+                                                            ('bar_graph_incidence', 'incidence_bar', 'submit-button3', 'date_picker3'),
+                                                            ('incidence_map', 'map', 'submit-button4', 'date_picker4')]:
+        app.clientside_callback(ClientsideFunction(namespace='covid', function_name=function_name),
+                                Output(figure_id, 'figure'),
+                                [Input(button_id, 'n_clicks')],
+                                [State(picker_id, 'start_date'),
+                                 State(picker_id, 'end_date'),
+                                 State('dataset-store', 'data')])
+
+if not CLIENTSIDE:
+    prewarm_figure_cache(datasets.current())
+
+# The reload thread runs in the process serving requests. Under gunicorn, gunicorn.conf.py starts one in every worker
+# after it's forked, so the master never holds a lock across a fork
 if __name__ == '__main__':
+    datasets.start()
     app.run_server()
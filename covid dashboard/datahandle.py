@@ -0,0 +1,107 @@
+import os
+import logging
+import threading
+from collections import namedtuple
+
+from dataset import DATA_DIR, MANIFEST, AGGREGATES_DIR, aggregates_directory, load_dataset, INCIDENCE_COLUMNS, ROLLING_COLUMNS
+
+# Versioned handle on the dataset that picks up new scrapes while the app runs.
+#
+# A background thread watches the manifest and, when it changes, maps the new snapshot and builds its running totals
+# off the request path, then swaps it in with a single assignment. Callbacks take the current snapshot once and use
+# only that, so a request that started on the old version finishes on it.
+#
+# The arrays and running totals are memory-mapped, so old and new snapshots, and every worker, share the operating
+# system's page cache: appended rows live in the same files, and files that were replaced stay readable until the last
+# old mapping is dropped.
+#
+# start() belongs in the process that serves requests. Threads don't survive a fork, and one forked while the watcher
+# held a lock would keep that lock held forever, so a preforking server starts it in each worker.
+
+log = logging.getLogger(__name__)
+
+# Seconds between manifest checks. 0 turns reloading off
+RELOAD_SECONDS = float(os.environ.get('COVID_RELOAD_SECONDS', 60))
+
+# Everything a callback needs from one version of the data
+Snapshot = namedtuple('Snapshot', ['dataset', 'incidence_aggregates', 'rolling_aggregates', 'version'])
+
+
+def build_snapshot(dataset, aggregates_dir=None):
+    return Snapshot(dataset,
+                    dataset.aggregates(INCIDENCE_COLUMNS, aggregates_dir),
+                    dataset.aggregates(ROLLING_COLUMNS, aggregates_dir),
+                    dataset.version)
+
+
+class DatasetHandle:
+
+    def __init__(self, path=DATA_DIR, interval=RELOAD_SECONDS, aggregates_dir=AGGREGATES_DIR):
+        self.path = path
+        self.interval = interval
+        self.aggregates_dir = None if aggregates_dir is None else aggregates_directory(path, aggregates_dir)
+        self.listeners = []
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.stamp = self.manifest_stamp()
+        self.snapshot = build_snapshot(load_dataset(path), self.aggregates_dir)
+
+    def current(self):
+        return self.snapshot
+
+    def manifest_stamp(self):
+
+        # The scraper renames a new manifest into place, so its mtime and size change with every update
+        try:
+            status = os.stat(os.path.join(self.path, MANIFEST))
+        except OSError:
+            return None
+
+        return status.st_mtime_ns, status.st_size
+
+    def swap(self, snapshot):
+
+        # Callbacks holding the old snapshot keep it until they return
+        self.snapshot = snapshot
+        for listener in self.listeners:
+            listener(snapshot)
+
+    def refresh(self):
+
+        # Load and swap in the dataset if the manifest changed since we last looked. Returns whether it was swapped
+        with self.lock:
+            stamp = self.manifest_stamp()
+            if stamp is None or stamp == self.stamp:
+                return False
+
+            dataset = load_dataset(self.path)
+            self.stamp = stamp
+            if dataset.version == self.snapshot.version:
+                return False
+
+            log.info('dataset version %s replaces %s', dataset.version, self.snapshot.version)
+            self.swap(build_snapshot(dataset, self.aggregates_dir))
+
+            return True
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                # A half-written or unreadable dataset is retried on the next check, the current one stays in use
+                log.exception('dataset reload failed')
+
+    def start(self):
+        if self.interval <= 0 or (self.thread and self.thread.is_alive()):
+            return
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.watch, name='dataset-reload', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
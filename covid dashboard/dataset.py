@@ -0,0 +1,166 @@
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from aggregates import RangeAggregates, date_rows
+
+# Memory-mapped view of the columnar dataset written by covid scrape/columnar.py.
+# Arrays are opened read-only straight from disk, so workers start without parsing anything and share pages through the OS cache.
+
+DATA_DIR = os.environ.get('COVID_DATA_DIR',
+                          os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'covid scrape', 'data'))
+
+MANIFEST = 'manifest.json'
+
+# Running totals are saved under here once per dataset version and mapped by every worker instead of each building
+# its own. Each data directory gets a folder of its own (see aggregates_directory)
+AGGREGATES_DIR = os.environ.get('COVID_AGGREGATES_DIR', os.path.join(tempfile.gettempdir(), 'covid-aggregates'))
+
+# Fallback when there's no local dataset: the CSVs the scraper publishes
+CSV_URLS = {'rolling_7_long': 'https://raw.githubusercontent.com/hrishipoola/berlin_covid_dashboard/main/covid%20scrape/rolling_7_long.csv',
+            'incidence': 'https://raw.githubusercontent.com/hrishipoola/berlin_covid_dashboard/main/covid%20scrape/incidence.csv'}
+
+# Long frame columns the dashboard uses, and the array behind each
+ROLLING_COLUMNS = {'Cases': 'rolling_cases'}
+INCIDENCE_COLUMNS = {'Cases': 'daily_cases', 'Incidence': 'incidence'}
+
+
+def melt(dates, districts, columns):
+
+    # Long frame from dates x districts matrices. Rows are district by district like the melted CSVs,
+    # and rows with missing values are dropped the same way. District is a categorical over the dataset's
+    # district order, so rows carry small integer codes and the names are only decoded when a chart is drawn
+    codes = np.repeat(np.arange(len(districts), dtype=np.int16), len(dates))
+    frame = pd.DataFrame({'District': pd.Categorical.from_codes(codes, categories=districts)},
+                         index=pd.DatetimeIndex(np.tile(dates, len(districts)), name='Date'))
+    for column, values in columns.items():
+        frame[column] = np.asarray(values).T.ravel()
+
+    return frame.dropna()
+
+
+def wide(frame, column, dates, districts):
+
+    # Dates x districts matrix of one column of a long (Date index, District column) frame, as the scrape's
+    # columnar.wide builds them for the files. The dashboard deploys on its own, so it can't import that one
+    return frame.reset_index().pivot(index='Date', columns='District', values=column).reindex(index=dates, columns=districts).values
+
+
+class Dataset:
+
+    def __init__(self, dates, districts, arrays, version):
+        self.dates = np.asarray(dates).astype('datetime64[ns]')
+        self.districts = list(districts)
+        self.arrays = arrays
+        self.version = version
+
+    def rows(self, start=None, end=None):
+        return date_rows(self.dates, start, end)
+
+    def window(self, name, start=None, end=None):
+
+        # Dates x districts block of one array for the requested dates
+        lo, hi = self.rows(start, end)
+
+        return self.arrays[name][lo:hi]
+
+    def long_frame(self, columns, start=None, end=None):
+
+        # Rebuild the long (Date index, District, values) frame the charts take, for the requested dates only
+        lo, hi = self.rows(start, end)
+
+        return melt(self.dates[lo:hi], self.districts, {column: self.arrays[name][lo:hi] for column, name in columns.items()})
+
+    def aggregates(self, columns, directory=None):
+
+        # Without a directory the totals are built in this process. With one, the first process to need them saves
+        # them there and everyone maps the saved files
+        if directory is None:
+            return RangeAggregates(self.dates, self.districts, {column: self.arrays[name] for column, name in columns.items()})
+
+        key = hashlib.sha1(json.dumps([self.districts, sorted(columns.items())]).encode()).hexdigest()[:12]
+        prefix = os.path.join(directory, '{}-{}'.format(self.version, key))
+        try:
+            return RangeAggregates.load(prefix, self.dates, self.districts, list(columns))
+        except (OSError, ValueError):
+            pass
+
+        os.makedirs(directory, exist_ok=True)
+        aggregates = self.aggregates(columns)
+        aggregates.save(prefix)
+
+        # Totals of other versions go. Processes still mapping them keep their pages until they let go
+        for file in os.listdir(directory):
+            if file.endswith('.npy') and not file.startswith(self.version + '-'):
+                try:
+                    os.remove(os.path.join(directory, file))
+                except OSError:
+                    pass
+
+        # If the saved files went in the meantime, this process keeps the ones it just built
+        try:
+            return RangeAggregates.load(prefix, self.dates, self.districts, list(columns))
+        except (OSError, ValueError):
+            return aggregates
+
+    @classmethod
+    def from_long_frames(cls, rolling_7_long, incidence, version=None):
+
+        # Shared date axis and district order, taken from the daily table which starts before the rolling one
+        dates = pd.DatetimeIndex(incidence.index.unique()).sort_values()
+        districts = list(incidence['District'].unique())
+
+        arrays = {'daily_cases': wide(incidence, 'Cases', dates, districts),
+                  'rolling_cases': wide(rolling_7_long, 'Cases', dates, districts),
+                  'incidence': wide(incidence, 'Incidence', dates, districts)}
+
+        # Read-only like the mapped arrays, so pages a preloaded app shares with its workers are never copied.
+        # The version comes from the contents so caches keyed on it notice when the CSVs change
+        digest = hashlib.sha1(json.dumps(districts).encode())
+        for values in arrays.values():
+            values.setflags(write=False)
+            digest.update(np.ascontiguousarray(values).tobytes())
+
+        return cls(dates.values, districts, arrays, version or 'csv-' + digest.hexdigest()[:16])
+
+
+def aggregates_directory(path=DATA_DIR, root=AGGREGATES_DIR):
+
+    # Folder for the saved totals of one data directory, so deployments on the same host don't remove each other's
+    return os.path.join(root, hashlib.sha1(os.path.realpath(path).encode()).hexdigest()[:12])
+
+
+def open_dataset(path=DATA_DIR):
+
+    with open(os.path.join(path, MANIFEST), encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    # Map every array read-only, shaped from the manifest
+    arrays = {}
+    for name, spec in manifest['arrays'].items():
+        shape = (manifest['rows'], spec['width']) if spec['width'] else (manifest['rows'],)
+        arrays[name] = np.memmap(os.path.join(path, spec['file']), dtype=spec['dtype'], mode='r', shape=shape)
+
+    dates = arrays.pop('dates').view('datetime64[D]')
+
+    return Dataset(dates, manifest['districts'], arrays, manifest['version'])
+
+
+def read_csv_dataset(urls=CSV_URLS):
+    rolling_7_long = pd.read_csv(urls['rolling_7_long'], parse_dates=['Date'], index_col='Date')
+    incidence = pd.read_csv(urls['incidence'], parse_dates=['Date'], index_col='Date')
+
+    return Dataset.from_long_frames(rolling_7_long, incidence)
+
+
+def load_dataset(path=DATA_DIR):
+
+    # Prefer the local memory-mapped copy, fall back to parsing the published CSVs
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        return open_dataset(path)
+
+    return read_csv_dataset()
@@ -0,0 +1,53 @@
+import numpy as np
+
+# Time bucketing for the stacked bar chart. The bucket size grows with the selected range so the number of bars
+# (dates x districts) stays under a budget however much history there is.
+
+# Bucket sizes from finest to coarsest, with the x-axis title used for each
+BUCKETS = ['day', 'week', 'month']
+BUCKET_TITLES = {'day': 'Date', 'week': 'Week starting', 'month': 'Month'}
+
+
+def bucket_keys(dates, bucket):
+
+    days = np.asarray(dates, dtype='datetime64[D]')
+
+    if bucket == 'week':
+        # 1970-01-01 was a Thursday, so shift by 3 days to start weeks on Monday
+        return (days.astype(np.int64) + 3) // 7
+    if bucket == 'month':
+        return days.astype('datetime64[M]').astype(np.int64)
+
+    return days.astype(np.int64)
+
+
+def choose_bucket(dates, n_series, budget):
+
+    # Finest bucket that keeps bars under the budget, or the coarsest one if none does
+    for bucket in BUCKETS:
+        if len(np.unique(bucket_keys(dates, bucket))) * n_series <= budget:
+            return bucket
+
+    return BUCKETS[-1]
+
+
+def bucket_means(dates, values, bucket):
+
+    # Average each district over every bucket. dates must be sorted so buckets are contiguous runs of rows
+    dates = np.asarray(dates)
+    values = np.asarray(values, dtype=float)
+    if bucket == 'day' or len(dates) == 0:
+        return dates, values
+
+    keys = bucket_keys(dates, bucket)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+    present = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(present, values, 0.0), starts, axis=0)
+    counts = np.add.reduceat(present, starts, axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+
+    # Each bucket is labelled with its first date in the range
+    return dates[starts], np.where(counts > 0, means, np.nan)
@@ -0,0 +1,191 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from instrument import phase
+
+# Bounded LRU cache of serialized figures, keyed by (chart, start, end, dataset version).
+# Entries are kept as JSON strings so their size is known, and can be shared between workers through an optional
+# directory, which is held under its own size limit by removing the least recently used files.
+
+
+class FigureCache:
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024, directory=None, version=lambda: '',
+                 max_disk_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.version = version
+        self.max_disk_bytes = max_disk_bytes
+
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.written = 0
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0}
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, name, start, end, version=None):
+        return (name, start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'), self.version() if version is None else version)
+
+    def path(self, key):
+
+        # Files are prefixed with the dataset version so stale ones are easy to find
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+        return os.path.join(self.directory, '{}-{}.json'.format(key[-1], digest))
+
+    def get(self, key):
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return self.entries[key]
+
+        # Another worker may already have built it
+        if self.directory:
+            try:
+                with open(self.path(key), encoding='utf-8') as f:
+                    payload = f.read()
+            except OSError:
+                pass
+            else:
+                self.store(key, payload)
+                with self.lock:
+                    self.counters['disk_hits'] += 1
+
+                # Mark it used, the directory is trimmed oldest modification time first
+                try:
+                    os.utime(self.path(key))
+                except OSError:
+                    pass
+                return payload
+
+        with self.lock:
+            self.counters['misses'] += 1
+
+        return None
+
+    def store(self, key, payload):
+
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= len(self.entries.pop(key))
+            self.entries[key] = payload
+            self.bytes += len(payload)
+
+            # Drop least recently used figures until we're back under both limits
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.counters['evictions'] += 1
+
+    def put(self, key, payload):
+
+        self.store(key, payload)
+
+        # Write to a temporary file and rename so other workers never read a partial figure
+        if self.directory:
+            path = self.path(key)
+            temporary = '{}.{}.tmp'.format(path, os.getpid())
+            try:
+                with open(temporary, 'w', encoding='utf-8') as f:
+                    f.write(payload)
+                os.replace(temporary, path)
+            except OSError:
+                return
+
+            # Every worker writes to the directory, so it's measured again after a tenth of the limit was written here
+            with self.lock:
+                self.written += len(payload)
+                trim = self.written >= self.max_disk_bytes // 10
+            if trim:
+                self.trim_directory()
+
+    def trim_directory(self):
+
+        # Remove the least recently used figures until the directory is under max_disk_bytes
+        with self.lock:
+            self.written = 0
+
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                try:
+                    status = entry.stat()
+                except OSError:
+                    continue
+                files.append((status.st_mtime, status.st_size, entry.path))
+
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            with self.lock:
+                self.counters['disk_evictions'] += 1
+
+    def prune_directory(self):
+
+        # Remove figures built from other dataset versions
+        if not self.directory:
+            return
+
+        prefix = self.version() + '-'
+        for file in os.listdir(self.directory):
+            if file.endswith('.json') and not file.startswith(prefix):
+                try:
+                    os.remove(os.path.join(self.directory, file))
+                except OSError:
+                    pass
+
+        self.trim_directory()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), bytes=self.bytes,
+                        max_entries=self.max_entries, max_bytes=self.max_bytes,
+                        max_disk_bytes=self.max_disk_bytes if self.directory else 0)
+
+    def cached(self, name, variant=None):
+
+        # Decorator for figure builders taking (data, start, end), where data.version is the version of the data the
+        # figure is built from. variant, if given, returns anything else the figure depends on for the key.
+        # Hits come back as the figure's JSON dict
+        def decorator(build):
+
+            @wraps(build)
+            def wrapper(data, start, end):
+                key = self.key(name if variant is None else '{}:{}'.format(name, variant()), start, end, data.version)
+                with phase('cache'):
+                    payload = self.get(key)
+                if payload is not None:
+                    return json.loads(payload)
+
+                fig = build(data, start, end)
+                with phase('serialize'):
+                    self.put(key, fig.to_json())
+
+                return fig
+
+            wrapper.uncached = build
+
+            return wrapper
+
+        return decorator
@@ -0,0 +1,209 @@
+import os
+import json
+import logging
+import time
+import tempfile
+from urllib.request import urlopen
+
+import numpy as np
+
+from geojson_rewind import rewind
+
+log = logging.getLogger(__name__)
+
+# Berlin district polygons. A local copy is used when present. Otherwise the file is downloaded once and kept in a
+# cache outside the repository, and if that fails too the map is drawn without polygons instead of the app not starting
+GEOJSON_URL = 'https://raw.githubusercontent.com/pape1412/airbnb/master/data/berlin_neighbourhood_groups.geojson'
+GEOJSON_PATH = os.environ.get('BERLIN_GEOJSON',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'berlin_neighbourhood_groups.geojson'))
+GEOJSON_CACHE = os.environ.get('COVID_GEOJSON_CACHE', os.path.join(tempfile.gettempdir(), 'berlin_neighbourhood_groups.geojson'))
+
+# Seconds to wait for the download before giving up on it, and before a request tries again after it failed
+DOWNLOAD_TIMEOUT = 10
+RETRY_SECONDS = float(os.environ.get('COVID_GEOJSON_RETRY_SECONDS', 300))
+
+# Berlin's extent (min lon, min lat, max lon, max lat), for sizing the map when there are no polygons
+BERLIN_BOUNDS = (13.08835, 52.33826, 13.76116, 52.67551)
+
+# Property key the choropleth matches district names against
+FEATURE_KEY = 'Gemeinde_name'
+
+# Douglas-Peucker tolerances in degrees. 0 keeps the full resolution polygons
+SIMPLIFY_LEVELS = {'full': 0.0, 'high': 0.0002, 'medium': 0.0006, 'low': 0.0015}
+
+# Coordinates are rounded to ~1m, which is well below a pixel at any zoom the dashboard uses
+COORDINATE_DECIMALS = 5
+
+_levels = None
+_bounds = None
+_loaded_at = None
+
+
+def load_geojson(path=GEOJSON_PATH, url=GEOJSON_URL, cache=GEOJSON_CACHE):
+
+    # Read the local copy, or one we downloaded before, if we have one
+    for local in (path, cache):
+        if os.path.exists(local):
+            with open(local, encoding='utf-8') as f:
+                return json.load(f)
+
+    # Otherwise fetch it and keep a copy so later starts don't hit the network
+    try:
+        with urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+            raw = response.read()
+        geojson = json.loads(raw)
+    except (OSError, ValueError) as error:
+        log.warning('no district polygons (%s not found and download failed: %s), the map is drawn without them', path, error)
+        return {'type': 'FeatureCollection', 'features': []}
+
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        with open(cache + '.tmp', 'wb') as f:
+            f.write(raw)
+        os.replace(cache + '.tmp', cache)
+    except OSError:
+        pass
+
+    return geojson
+
+
+def simplify_ring(ring, tolerance):
+
+    points = np.asarray(ring, dtype=float)
+
+    # Nothing to drop on tiny rings or when no tolerance is set
+    if tolerance <= 0 or len(points) <= 4:
+        return points
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    # Iterative Douglas-Peucker: keep the point furthest from each segment while it's further than the tolerance
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        start, end = points[first], points[last]
+        segment = end - start
+        inner = points[first + 1:last]
+        length = np.hypot(segment[0], segment[1])
+
+        if length == 0:
+            distances = np.hypot(inner[:, 0] - start[0], inner[:, 1] - start[1])
+        else:
+            distances = np.abs(segment[0] * (inner[:, 1] - start[1]) - segment[1] * (inner[:, 0] - start[0])) / length
+
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            split = first + 1 + index
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    simplified = points[keep]
+
+    # A closed ring needs at least 4 positions, fall back to the original if we collapsed it
+    if len(simplified) < 4:
+        return points
+
+    return simplified
+
+
+def simplify_geometry(geometry, tolerance):
+
+    def ring_coords(ring):
+        return np.round(simplify_ring(ring, tolerance), COORDINATE_DECIMALS).tolist()
+
+    if geometry['type'] == 'Polygon':
+        coordinates = [ring_coords(ring) for ring in geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        coordinates = [[ring_coords(ring) for ring in polygon] for polygon in geometry['coordinates']]
+    else:
+        coordinates = geometry['coordinates']
+
+    return {'type': geometry['type'], 'coordinates': coordinates}
+
+
+def simplify_features(geojson, tolerance):
+
+    # Keep only the property the choropleth matches on to keep the figure payload small
+    features = [{'type': 'Feature',
+                 'properties': {FEATURE_KEY: feature['properties'][FEATURE_KEY]},
+                 'geometry': simplify_geometry(feature['geometry'], tolerance)}
+                for feature in geojson['features']]
+
+    collection = {'type': 'FeatureCollection', 'features': features}
+
+    # Rewind so plotly fills the polygons rather than everything outside them
+    return rewind(collection, rfc7946=False)
+
+
+def geometry_bounds(geojson):
+
+    coordinates = []
+
+    def collect(value):
+        if isinstance(value[0], (int, float)):
+            coordinates.append(value[:2])
+        else:
+            for item in value:
+                collect(item)
+
+    for feature in geojson['features']:
+        collect(feature['geometry']['coordinates'])
+    if not coordinates:
+        return BERLIN_BOUNDS
+
+    coordinates = np.asarray(coordinates)
+
+    return coordinates[:, 0].min(), coordinates[:, 1].min(), coordinates[:, 0].max(), coordinates[:, 1].max()
+
+
+def load_levels(path=GEOJSON_PATH):
+
+    global _levels, _bounds, _loaded_at
+
+    # Load, simplify and rewind every level once. Callbacks only ever read the cached results, except that without
+    # polygons (the download failed) a request tries again every RETRY_SECONDS
+    if _levels is None or (not has_polygons() and time.monotonic() - _loaded_at >= RETRY_SECONDS):
+        berlin_districts = load_geojson(path)
+        _bounds = geometry_bounds(berlin_districts)
+        _levels = {name: simplify_features(berlin_districts, tolerance) for name, tolerance in SIMPLIFY_LEVELS.items()}
+        _loaded_at = time.monotonic()
+
+    return _levels
+
+
+def has_polygons():
+    return bool(_levels and _levels['full']['features'])
+
+
+def cache_variant():
+
+    # Figure cache variant for the map, so maps drawn without polygons aren't served once they're back
+    load_levels()
+
+    return 'polygons' if has_polygons() else 'no-polygons'
+
+
+def district_geometry(level='full'):
+    return load_levels()[level]
+
+
+def geometry_for_viewport(width, height):
+
+    load_levels()
+
+    # Degrees covered by one pixel once the map is fitted to Berlin's bounds
+    min_lon, min_lat, max_lon, max_lat = _bounds
+    degrees_per_pixel = min((max_lon - min_lon) / width, (max_lat - min_lat) / height)
+
+    # Coarsest level whose tolerance still stays under a pixel
+    level = 'full'
+    for name, tolerance in sorted(SIMPLIFY_LEVELS.items(), key=lambda item: item[1]):
+        if tolerance <= degrees_per_pixel:
+            level = name
+
+    return _levels[level]
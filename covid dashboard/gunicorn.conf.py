@@ -0,0 +1,29 @@
+import gc
+import os
+
+# Gunicorn settings, picked up by `gunicorn covid_dash:server` run from this folder.
+#
+# The app is imported once in the master (preload) and the workers are forked from it, so the mapped dataset, running
+# totals, simplified geometry and the imported libraries are shared between them instead of loaded once per worker.
+# Set COVID_PRELOAD=0 to have every worker import the app itself.
+
+preload_app = os.environ.get('COVID_PRELOAD', '1') == '1'
+
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 8000))
+
+
+def pre_fork(server, worker):
+
+    # Move everything the master allocated out of the collector's reach, so collections in the workers don't write
+    # to (and copy) the shared pages
+    gc.freeze()
+
+
+def post_worker_init(worker):
+
+    # Every worker watches for new scrapes itself. Started here rather than when the app is imported, so the master
+    # has no thread that could be holding a lock when it forks
+    import covid_dash
+    covid_dash.datasets.start()
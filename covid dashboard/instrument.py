@@ -0,0 +1,195 @@
+import os
+import time
+import random
+import cProfile
+import tempfile
+import threading
+
+import flask
+
+# Per-callback timing for the Dash server. Callbacks mark their phases (filtering, aggregation, figure building,
+# serialization) with `with phase('build'):`, and every /_dash-update-component request records the time in each,
+# the rest of the request and the response size. Results go out as a Server-Timing header on the response and in
+# Prometheus text format at /metrics. A sample of requests can be run under cProfile.
+#
+# Everything is off unless COVID_METRICS=1. Then nothing is installed on the server and phase() hands back a shared
+# do-nothing context manager.
+
+ENABLED = os.environ.get('COVID_METRICS', '0') == '1'
+
+# Fraction of callback requests to profile, and where their .prof files go
+PROFILE_RATE = float(os.environ.get('COVID_PROFILE_RATE', 0))
+PROFILE_DIR = os.environ.get('COVID_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'covid-profiles'))
+
+CALLBACK_PATH = '/_dash-update-component'
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class NullPhase:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_PHASE = NullPhase()
+
+
+class Phase:
+
+    __slots__ = ('phases', 'name', 'start')
+
+    def __init__(self, phases, name):
+        self.phases = phases
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.phases[self.name] = self.phases.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+def phase(name):
+
+    # Time a block as part of the current callback request. Outside one (or with metrics off) it does nothing
+    if not ENABLED or not flask.has_request_context():
+        return NULL_PHASE
+
+    phases = getattr(flask.g, 'phases', None)
+
+    return NULL_PHASE if phases is None else Phase(phases, name)
+
+
+def label_text(labels):
+    return ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items())
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.callbacks = {}
+        self.phases = {}
+
+    def record(self, callback, seconds, phases, size, error):
+        with self.lock:
+            entry = self.callbacks.get(callback)
+            if entry is None:
+                entry = self.callbacks[callback] = {'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'seconds': 0.0,
+                                                    'bytes': 0, 'errors': 0}
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['bytes'] += size
+            entry['errors'] += error
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    entry['buckets'][i] += 1
+
+            for name, elapsed in phases.items():
+                self.phases[callback, name] = self.phases.get((callback, name), 0.0) + elapsed
+
+    def render(self, extra=()):
+
+        # Prometheus text exposition format. extra holds (name, type, help, value, labels) for other metrics
+        lines = ['# HELP covid_callback_seconds Time to answer a Dash callback request',
+                 '# TYPE covid_callback_seconds histogram']
+        with self.lock:
+            callbacks = {name: dict(entry, buckets=list(entry['buckets'])) for name, entry in self.callbacks.items()}
+            phases = dict(self.phases)
+
+        for name, entry in sorted(callbacks.items()):
+            for bound, count in zip(LATENCY_BUCKETS, entry['buckets']):
+                lines.append('covid_callback_seconds_bucket{{{}}} {}'.format(label_text({'callback': name, 'le': bound}), count))
+            lines.append('covid_callback_seconds_bucket{{{}}} {}'.format(label_text({'callback': name, 'le': '+Inf'}), entry['count']))
+            lines.append('covid_callback_seconds_sum{{{}}} {}'.format(label_text({'callback': name}), entry['seconds']))
+            lines.append('covid_callback_seconds_count{{{}}} {}'.format(label_text({'callback': name}), entry['count']))
+
+        lines += ['# HELP covid_callback_phase_seconds_total Time spent in each phase of a callback',
+                  '# TYPE covid_callback_phase_seconds_total counter']
+        for (name, phase_name), seconds in sorted(phases.items()):
+            lines.append('covid_callback_phase_seconds_total{{{}}} {}'.format(label_text({'callback': name, 'phase': phase_name}), seconds))
+
+        for metric, key, description in (('covid_callback_response_bytes_total', 'bytes', 'Response bytes before compression'),
+                                         ('covid_callback_errors_total', 'errors', 'Callback requests answered with an error status')):
+            lines += ['# HELP {} {}'.format(metric, description), '# TYPE {} counter'.format(metric)]
+            for name, entry in sorted(callbacks.items()):
+                lines.append('{}{{{}}} {}'.format(metric, label_text({'callback': name}), entry[key]))
+
+        for name, kind, description, value, labels in extra:
+            lines += ['# HELP {} {}'.format(name, description), '# TYPE {} {}'.format(name, kind)]
+            lines.append('{}{{{}}} {}'.format(name, label_text(labels), value) if labels else '{} {}'.format(name, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def callback_name(app, output):
+
+    # The function behind an output, e.g. 'bar_graph.figure' -> 'update_bar_graph'
+    entry = app.callback_map.get(output, {})
+    function = entry.get('callback')
+
+    return getattr(function, '__name__', output)
+
+
+def install(app, extra=lambda: ()):
+
+    # Hook the timing into the Flask server behind the Dash app and add /metrics. extra returns more metrics for it
+    if not ENABLED:
+        return
+
+    server = app.server
+
+    @server.before_request
+    def start_timing():
+        if not ENABLED or flask.request.path != CALLBACK_PATH:
+            return
+
+        flask.g.phases = {}
+        flask.g.request_start = time.perf_counter()
+        if PROFILE_RATE and random.random() < PROFILE_RATE:
+            flask.g.profiler = cProfile.Profile()
+            flask.g.profiler.enable()
+
+    @server.after_request
+    def finish_timing(response):
+        start = getattr(flask.g, 'request_start', None)
+        if start is None:
+            return response
+
+        seconds = time.perf_counter() - start
+        body = flask.request.get_json(silent=True) or {}
+        name = callback_name(app, body.get('output', ''))
+
+        profiler = getattr(flask.g, 'profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(os.path.join(PROFILE_DIR, '{}-{}-{}.prof'.format(name, int(time.time() * 1000), os.getpid())))
+
+        # Whatever the marked phases don't cover is Dash reading the request, calling back and encoding the response
+        phases = dict(flask.g.phases)
+        phases['respond'] = max(0.0, seconds - sum(phases.values()))
+
+        size = response.calculate_content_length()
+        if size is None and not response.direct_passthrough:
+            size = len(response.get_data())
+        metrics.record(name, seconds, phases, size or 0, response.status_code >= 400)
+
+        response.headers['Server-Timing'] = ', '.join(['{};dur={:.2f}'.format(phase_name, elapsed * 1000) for phase_name, elapsed in phases.items()] +
+                                                      ['total;dur={:.2f}'.format(seconds * 1000)])
+
+        return response
+
+    @server.route('/metrics')
+    def prometheus_metrics():
+        return flask.Response(metrics.render(extra()), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,118 @@
+import gzip
+import json
+
+import numpy as np
+import pandas as pd
+
+import covid_dash
+import api
+import dataset
+from benchmark import random_ranges
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# What the data API has to answer, without the timings in benchmark.py. Run with pytest, or `python test_api.py`
+
+client = covid_dash.server.test_client()
+
+ENCODINGS = [('gzip', gzip.decompress)] + ([('br', brotli.decompress)] if brotli else [])
+
+
+def url(start, end, extra=''):
+    return '/api/v1/aggregates?start={:%Y-%m-%d}&end={:%Y-%m-%d}{}'.format(start, end, extra)
+
+
+def some_range(seed=0):
+    return random_ranges(pd.DatetimeIndex(covid_dash.datasets.current().dataset.dates), 1, seed)[0]
+
+
+def test_aggregates_match_pandas():
+    data = covid_dash.datasets.current()
+    incidence = data.dataset.long_frame(dataset.INCIDENCE_COLUMNS)
+    rolling = data.dataset.long_frame(dataset.ROLLING_COLUMNS)
+
+    for start, end in random_ranges(pd.DatetimeIndex(data.dataset.dates), 10, seed=4):
+        result = pd.DataFrame(client.get(url(start, end)).get_json()['districts']).set_index('District')
+        selected = incidence[(incidence.index >= start) & (incidence.index <= end)].groupby('District', observed=True)
+        expected = selected[['Cases', 'Incidence']].mean()
+        np.testing.assert_allclose(result.loc[expected.index, ['mean_daily_cases', 'mean_incidence']].values, expected.values)
+        np.testing.assert_allclose(result.loc[expected.index, 'total_cases'].values, selected['Cases'].sum().values)
+        rolling_means = rolling[(rolling.index >= start) & (rolling.index <= end)].groupby('District', observed=True)['Cases'].mean()
+        np.testing.assert_allclose(result.loc[rolling_means.index, 'mean_rolling_cases'].values, rolling_means.values)
+
+
+def test_bad_dates_are_rejected():
+    assert client.get('/api/v1/aggregates?start=yesterday').status_code == 400
+    assert client.get('/api/v1/aggregates?start=2020-12-01&end=2020-11-01').status_code == 400
+
+
+def test_repeat_with_etag_is_not_modified():
+    start, end = some_range()
+    first = client.get(url(start, end))
+    assert first.status_code == 200 and first.headers['Cache-Control'] == 'public, max-age={}'.format(api.MAX_AGE)
+
+    repeat = client.get(url(start, end), headers={'If-None-Match': first.headers['ETag']})
+    assert repeat.status_code == 304 and not repeat.data and repeat.headers['ETag'] == first.headers['ETag']
+
+    if api.pa is not None:
+        assert client.get(url(start, end, '&format=arrow')).headers['ETag'] != first.headers['ETag']
+
+
+def test_compressed_responses_revalidate_before_computing():
+
+    # Browsers always send Accept-Encoding, and their 304 has to come before any aggregates are computed
+    start, end = some_range(1)
+    computed = []
+    range_aggregates = api.range_aggregates
+    api.range_aggregates = lambda *a: computed.append(a) or range_aggregates(*a)
+    try:
+        for encoding, decompress in ENCODINGS:
+            first = client.get(url(start, end), headers={'Accept-Encoding': encoding})
+            assert first.headers.get('Content-Encoding') == encoding, encoding
+            del computed[:]
+            repeat = client.get(url(start, end), headers={'Accept-Encoding': encoding, 'If-None-Match': first.headers['ETag']})
+            assert repeat.status_code == 304 and not computed, encoding
+    finally:
+        api.range_aggregates = range_aggregates
+
+
+def test_compressed_bodies_decode_to_the_same_json():
+    start, end = some_range(2)
+    plain = client.get(url(start, end), headers={'Accept-Encoding': 'identity'})
+    for encoding, decompress in ENCODINGS:
+        response = client.get(url(start, end), headers={'Accept-Encoding': encoding})
+        assert json.loads(decompress(response.data)) == plain.get_json(), encoding
+
+
+def test_etag_changes_with_dataset_version():
+    start, end = some_range(3)
+    first = client.get(url(start, end))
+
+    # Set the snapshot directly rather than through swap(), which would rebuild the default figures
+    snapshot = covid_dash.datasets.current()
+    covid_dash.datasets.snapshot = snapshot._replace(version=snapshot.version + '-next')
+    try:
+        repeat = client.get(url(start, end), headers={'If-None-Match': first.headers['ETag']})
+        assert repeat.status_code == 200 and repeat.headers['ETag'] != first.headers['ETag']
+    finally:
+        covid_dash.datasets.snapshot = snapshot
+
+
+def test_arrow_matches_json():
+    if api.pa is None:
+        return
+
+    start, end = some_range(4)
+    plain = client.get(url(start, end)).get_json()
+    table = api.pa.ipc.open_stream(client.get(url(start, end, '&format=arrow')).data).read_all().to_pandas()
+    assert table['District'].tolist() == [row['District'] for row in plain['districts']]
+
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'passed')
@@ -0,0 +1,372 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+import covid_scrape
+import fetch
+import metrics
+import regions
+from extract import read_table
+from benchtools import timed, report, measure, results_table
+
+# Benchmarks for the scrape stages on synthetic tables. Run one section with e.g. `python benchmark.py incremental`
+
+
+def region_acronyms(n_districts):
+
+    # The registry's regions first, then made up ones for scaling past Berlin
+    return (regions.ACRONYMS + ['R{:03d}'.format(i) for i in range(len(regions.ACRONYMS) + 1, n_districts + 1)])[:n_districts]
+
+
+def synthetic_raw(days, seed=0, n_districts=12):
+
+    # Table shaped like the LAGeSo one after read_html: day-first date strings, float counts, a trailing empty row
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2020-03-03', periods=days, freq='D')
+    t = np.arange(days)[:, None]
+    cases = rng.poisson(rng.uniform(5, 60, n_districts) * (1.2 + np.sin(2 * np.pi * t / 365)))
+
+    raw = pd.DataFrame(cases.astype(float), columns=region_acronyms(n_districts))
+    raw.insert(0, 'Datum', dates.strftime('%d.%m.%Y'))
+
+    return pd.concat([raw, pd.DataFrame({'Datum': [np.nan]})], ignore_index=True)
+
+
+def html_table(frame, attributes=''):
+    header = ''.join('<th>{}</th>'.format(name) for name in frame.columns)
+    rows = ''.join('<tr>{}</tr>'.format(''.join('<td>{}</td>'.format('' if pd.isna(value) else value) for value in row))
+                   for row in frame.itertuples(index=False))
+    return '<table {}><tbody><tr>{}</tr>{}</tbody></table>'.format(attributes, header, rows)
+
+
+# Navigation and text around the tables, so the synthetic pages look like the real thing
+FILLER = '<div class="nav">' + '<p>Lorem ipsum <a href="#">dolor</a> sit amet.</p>' * 200 + '</div>'
+
+
+def lageso_page(cases):
+    return '<html><head><meta charset="utf-8"><title>Fallzahlen</title></head><body>{0}{1}{0}</body></html>'.format(FILLER, html_table(cases, 'class="datatable"')).encode('utf-8')
+
+
+def synthetic_pages(rows, seed=0):
+
+    # Stand-ins for the two pages: the case table first on a LAGeSo-like page, the population table fifth on a
+    # Wikipedia-like one
+    rng = np.random.default_rng(seed)
+
+    boroughs = pd.DataFrame({'Borough': ['Borough {}'.format(i) for i in range(rows)] + ['Total'],
+                             'Population 2010': ['{:,}'.format(value) for value in rng.integers(200000, 400000, rows + 1)],
+                             'Area in km²': np.round(rng.uniform(20, 100, rows + 1), 2)})
+    small = pd.DataFrame({'Year': range(1990, 2010), 'Value': range(20)})
+    wikipedia = '<html><head><meta charset="utf-8"></head><body>{0}{1}{0}{1}{0}{1}{0}{1}{2}{0}{1}</body></html>'.format(FILLER, html_table(small, 'class="wikitable"'),
+                                                                               html_table(boroughs, 'class="wikitable sortable"'))
+
+    return {'lageso (table 0)': (lageso_page(synthetic_raw(rows, seed)), 0), 'wikipedia (table 4)': (wikipedia.encode('utf-8'), 4)}
+
+
+def bench_extract(args):
+
+    from bs4 import BeautifulSoup
+
+    def parse_twice(page, index):
+        # The old path: parse the page, find the table, turn it back into a string and parse it again
+        table = BeautifulSoup(page, 'lxml').find_all('table')
+        return pd.read_html(str(table[index]), index_col=None, header=0)[0]
+
+    for rows in args.rows:
+        for name, (page, index) in synthetic_pages(rows).items():
+            expected = parse_twice(page, index)
+            actual = read_table(page, index)
+            pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+            seconds, _ = timed(lambda: parse_twice(page, index), 3)
+            report('{}, {} rows: bs4 + read_html'.format(name, rows), seconds, len(page))
+            seconds, _ = timed(lambda: read_table(page, index), 3)
+            report('{}, {} rows: single pass'.format(name, rows), seconds, len(page))
+    print('single pass tables match bs4 + read_html')
+
+
+def local_server(pages, latency, stalled=()):
+
+    # Stand-in for the source sites: serves fixed pages after a delay, with ETag / Last-Modified support
+    # and a log of the status codes it sent. Paths in stalled always get a 200 and its headers, but the body never arrives
+    log = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            body = pages[self.path]
+            etag = '"{}"'.format(hash(body) & 0xffffffff)
+            if self.headers.get('If-None-Match') == etag and self.path not in stalled:
+                log.append(304)
+                self.send_response(304)
+                self.end_headers()
+                return
+            log.append(200)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', 'Tue, 05 Jan 2021 00:00:00 GMT')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.path in stalled:
+                self.wfile.flush()
+                time.sleep(2)
+                return
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, log
+
+
+def bench_fetch(args):
+
+    pages = {'/cases': synthetic_pages(300)['lageso (table 0)'][0], '/population': synthetic_pages(12)['wikipedia (table 4)'][0]}
+    stalled = set()
+    server, log = local_server(pages, args.latency, stalled)
+    base = 'http://127.0.0.1:{}'.format(server.server_port)
+    workdir = tempfile.mkdtemp()
+
+    def sources(ttl):
+        return {'cases': fetch.Source(base + '/cases', ttl=0), 'population': fetch.Source(base + '/population', ttl=ttl)}
+
+    def run(name, function):
+        del log[:]
+        start = time.perf_counter()
+        result = function()
+        report('{} (server sent {})'.format(name, log), time.perf_counter() - start)
+        return result
+
+    try:
+        run('sequential, no cache', lambda: [fetch.fetch(source, os.path.join(workdir, 'sequential'))
+                                             for source in sources(0).values()])
+        run('concurrent, cold cache', lambda: fetch.fetch_all(sources(0), workdir))
+        run('concurrent, revalidated', lambda: fetch.fetch_all(sources(0), workdir))
+        run('concurrent, population inside TTL', lambda: fetch.fetch_all(sources(3600), workdir))
+
+        # How long falling back to the cached copy takes when the body stalls, and when the server is gone.
+        # What comes back in each case is checked in test_scrape.py
+        stalled.add('/cases')
+        run('body stalls', lambda: fetch.fetch(fetch.Source(base + '/cases', ttl=0), workdir, retries=1, backoff=0.01, timeout=0.5))
+        stalled.clear()
+
+        server.shutdown()
+        server.server_close()
+        run('server down', lambda: fetch.fetch_all(sources(0), workdir, retries=1, backoff=0.01, timeout=1))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def synthetic_population(seed=0, n_districts=12):
+
+    # District names as the scrape spells them out
+    covid_scrape.covid_raw = synthetic_raw(1, n_districts=n_districts)
+    districts = list(covid_scrape.covid_wide_dataframe().columns.drop('Date'))
+
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'District': districts, 'Population 2010': rng.integers(200000, 400000, len(districts))})
+
+
+def full_build(raw, population, path):
+
+    # The whole pipeline on a table we already have
+    covid_scrape.covid_raw = raw
+    covid_scrape.covid_wide_dataframe()
+    covid_scrape.covid_long_dataframe()
+    covid_scrape.rolling_7_dataframe()
+    covid_scrape.population = population
+    covid_scrape.incidence_dataframe()
+
+    return covid_scrape.export_dataset(path)
+
+
+def bench_incremental(args):
+
+    population = synthetic_population()
+    workdir = tempfile.mkdtemp()
+    try:
+        full_path = os.path.join(workdir, 'full')
+        incremental_path = os.path.join(workdir, 'incremental')
+
+        # Seed the incremental dataset with the first days, then add one day at a time from the page as it would be
+        # downloaded that day, so parsing it is part of the time
+        raw = synthetic_raw(args.days)
+        full_build(raw.iloc[:args.seed_days], population, incremental_path)
+        times = []
+        for day in range(args.seed_days + 1, args.days + 1):
+            page = lageso_page(pd.concat([raw.iloc[:day], raw.iloc[-1:]]))
+            covid_scrape.pages = {'cases': fetch.Page('', page, 'utf-8', 200)}
+            start = time.perf_counter()
+            covid_scrape.incremental_update(incremental_path)
+            times.append(time.perf_counter() - start)
+        covid_scrape.pages = {}
+
+        # Against building everything in one go, which test_scrape.py checks it comes out the same as
+        start = time.perf_counter()
+        full_build(raw, population, full_path)
+        full_seconds = time.perf_counter() - start
+
+        # The table runs oldest first, so the new day is at the end and the whole page still has to be parsed.
+        # Old rows are dropped as they're read, which leaves the HTML parse as the only part that grows with history
+        last = pd.to_datetime(raw['Datum'].iloc[-3], dayfirst=True).to_pydatetime()
+        parse_seconds, _ = timed(lambda: read_table(page, keep=covid_scrape.rows_after(last)), 3)
+        whole_seconds, _ = timed(lambda: read_table(page), 3)
+
+        report('full rebuild, {} days'.format(args.days), full_seconds)
+        report('incremental update from the page, day {}'.format(args.seed_days + 1), times[0])
+        report('incremental update from the page, day {}'.format(args.days), times[-1])
+        report('  of which parsing the page, new rows only', parse_seconds, len(page))
+        report('  parsing the page, every row', whole_seconds, len(page))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_stages(args):
+
+    rows = []
+    workdir = tempfile.mkdtemp()
+    try:
+        for n_districts in args.districts:
+            population = synthetic_population(n_districts=n_districts)
+            for years in args.years:
+                raw = synthetic_raw(int(years * 365), n_districts=n_districts)
+
+                # Stages run in pipeline order, each timed on the state the previous ones leave behind
+                def stage_runs():
+                    covid_scrape.covid_raw = raw
+                    covid_scrape.population = population
+                    return [('covid_wide_dataframe', covid_scrape.covid_wide_dataframe),
+                            ('covid_long_dataframe', covid_scrape.covid_long_dataframe),
+                            ('rolling_7_dataframe', covid_scrape.rolling_7_dataframe),
+                            ('incidence_dataframe', covid_scrape.incidence_dataframe),
+                            ('export_dataset', lambda: covid_scrape.export_dataset(workdir))]
+
+                timings = {}
+                for _ in range(args.repeat):
+                    for name, stage in stage_runs():
+                        start = time.perf_counter()
+                        stage()
+                        timings[name] = min(timings.get(name, np.inf), time.perf_counter() - start)
+
+                for name, stage in stage_runs():
+                    tracemalloc.start()
+                    try:
+                        stage()
+                        peak = tracemalloc.get_traced_memory()[1]
+                    finally:
+                        tracemalloc.stop()
+                    rows.append({'stage': name, 'districts': n_districts, 'years': years,
+                                 'ms': round(timings[name] * 1000, 2), 'peak_kb': peak // 1024})
+    finally:
+        shutil.rmtree(workdir)
+
+    return results_table(rows, args)
+
+
+def bench_regions(args):
+
+    # Long incidence tables with District as repeated names against region codes
+    rows = []
+    for n_districts in args.districts:
+        population = synthetic_population(n_districts=n_districts)
+        covid_scrape.covid_raw = synthetic_raw(int(args.days), n_districts=n_districts)
+        covid_scrape.population = population
+        covid_scrape.covid_wide_dataframe()
+        covid_scrape.covid_long_dataframe()
+        coded = covid_scrape.incidence_dataframe()
+        named = coded.assign(District=coded['District'].astype(object))
+
+        for label, frame in (('names', named), ('codes', coded)):
+            seconds, peak, _ = measure(lambda: frame.groupby('District', observed=True)['Incidence'].mean(), args.repeat)
+            join_seconds, _, _ = measure(lambda: frame['District'].map(population.set_index('District')['Population 2010']), args.repeat)
+            rows.append({'District as': label, 'districts': n_districts, 'rows': len(frame),
+                         'memory_kb': frame.memory_usage(deep=True).sum() // 1024,
+                         'groupby_ms': round(seconds * 1000, 2), 'population_map_ms': round(join_seconds * 1000, 2)})
+
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+def pandas_metrics(cases, population, windows):
+
+    # One rolling pass per window, the way rolling_7_dataframe does it
+    frame = pd.DataFrame(cases)
+    result = {}
+    for window in sorted(set(windows) | {metrics.GROWTH_WINDOW}):
+        sums = frame.rolling(window).sum()
+        if window in windows:
+            result['cases_{}d'.format(window)] = sums.values
+            result['incidence_{}d'.format(window)] = (sums / population * 100000).values
+        if window == metrics.GROWTH_WINDOW:
+            weekly = sums
+    growth = weekly / weekly.shift(metrics.GROWTH_WINDOW) - 1
+    result['growth_wow'] = growth.where(np.isfinite(growth)).values
+
+    return result
+
+
+def bench_metrics(args):
+
+    # The cumulative sum engine against a pandas rolling pass per window, for more and more windows
+    rows = []
+    rng = np.random.default_rng(0)
+    for n_districts in args.districts:
+        population = rng.integers(200000, 400000, n_districts).astype(float)
+        for years in args.years:
+            cases = rng.poisson(50, (int(years * 365), n_districts)).astype(float)
+            for windows in (metrics.WINDOWS[:1], metrics.WINDOWS, metrics.WINDOWS + (56, 91)):
+                expected = pandas_metrics(cases, population, windows)
+                actual = metrics.compute_metrics(cases, population, windows)
+                for name in expected:
+                    np.testing.assert_allclose(actual[name], expected[name], rtol=1e-9, err_msg=name)
+
+                for label, function in (('pandas rolling', lambda: pandas_metrics(cases, population, windows)),
+                                        ('cumulative sum', lambda: metrics.compute_metrics(cases, population, windows))):
+                    seconds, peak, _ = measure(function, args.repeat)
+                    rows.append({'engine': label, 'windows': len(windows), 'districts': n_districts, 'years': years,
+                                 'ms': round(seconds * 1000, 2), 'peak_kb': peak // 1024})
+    print('cumulative sum metrics match pandas rolling windows')
+
+    return results_table(rows, args)
+
+
+SECTIONS = {'incremental': bench_incremental,
+            'extract': bench_extract,
+            'fetch': bench_fetch,
+            'stages': bench_stages,
+            'regions': bench_regions,
+            'metrics': bench_metrics}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Berlin covid scrape')
+    parser.add_argument('section', choices=sorted(SECTIONS))
+    parser.add_argument('--days', type=int, default=3 * 365, help='days of synthetic history')
+    parser.add_argument('--seed-days', type=int, default=30, help='days in the dataset before incremental updates start')
+    parser.add_argument('--latency', type=float, default=0.3, help='seconds the local stand-in server waits per request')
+    parser.add_argument('--rows', type=int, nargs='+', default=[300, 3000, 30000], help='table sizes for the extract benchmark')
+    parser.add_argument('--districts', type=int, nargs='+', default=[12, 100, 400], help='region counts for the stages benchmark')
+    parser.add_argument('--years', type=float, nargs='+', default=[1, 5, 10], help='history lengths for the stages benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per timing, the best one counts')
+    parser.add_argument('--save', help='write the results to this CSV')
+    parser.add_argument('--compare', help='baseline CSV to check the results against')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='slowdown against the baseline that counts as a regression')
+    args = parser.parse_args(argv)
+
+    return SECTIONS[args.section](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+import time
+import tracemalloc
+
+import pandas as pd
+
+# Timing, reporting and baseline helpers shared by the scrape and dashboard benchmarks
+
+
+def timed(function, repeat=5):
+
+    # Best of a few runs so one slow run doesn't skew the numbers
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+
+def report(name, seconds, size=None):
+    line = '{:<48} {:>10.2f} ms'.format(name, seconds * 1000)
+    if size is not None:
+        line += ' {:>12,} bytes'.format(size)
+    print(line)
+
+
+def measure(function, repeat=3):
+
+    # Best wall time over a few runs, then one more run under tracemalloc for the peak Python allocation
+    seconds, result = timed(function, repeat)
+
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return seconds, peak, result
+
+
+# Result columns that are measurements rather than part of what was measured
+MEASURED = ('ms', 'peak_kb', 'bytes', 'p50_ms', 'p95_ms', 'p99_ms', 'requests', 'errors', 'error_rate', 'rps')
+
+
+def results_table(rows, args, metric='ms'):
+
+    # Print the results, optionally save them, and fail if metric got slower than a saved baseline allows
+    results = pd.DataFrame(rows)
+    print(results.to_string(index=False))
+
+    if args.save:
+        results.to_csv(args.save, index=False)
+
+    if args.compare:
+        keys = [column for column in results.columns if column not in MEASURED]
+        baseline = pd.read_csv(args.compare)
+        merged = results.merge(baseline, on=keys, suffixes=('', '_baseline'))
+        slower = merged[merged[metric] > merged[metric + '_baseline'] * args.tolerance]
+        if len(slower):
+            print('{} slower than baseline by more than {}x:'.format(metric, args.tolerance))
+            print(slower[keys + [metric, metric + '_baseline']].to_string(index=False))
+            return 1
+
+    return 0
@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+import regions
+import metrics
+
+# Binary columnar copy of the scraped tables for the dashboard to memory-map.
+#
+# A dataset directory holds one raw little-endian file per array plus manifest.json. Every array has one row per date
+# (dates are stored as days since 1970-01-01) and one column per district, in C order, so the dashboard can np.memmap
+# them straight from the page cache without parsing anything.
+
+MANIFEST = 'manifest.json'
+FORMAT = 1
+
+# Arrays the dashboard reads, with the on-disk dtype of each. The rolling window metrics are stored next to the tables
+ARRAYS = {'daily_cases': '<i4',
+          'rolling_cases': '<f8',
+          'incidence': '<f8'}
+ARRAYS.update({name: '<f8' for name in metrics.metric_names()})
+
+
+def array_version(previous, *chunks):
+
+    # Versions are chained hashes of the bytes written, so they change whenever the data does
+    digest = hashlib.sha1(previous.encode())
+    for chunk in chunks:
+        digest.update(np.ascontiguousarray(chunk).tobytes())
+
+    return digest.hexdigest()[:16]
+
+
+def write_manifest(path, manifest):
+
+    # Write to a temporary file and rename over the old manifest so readers never see half of one
+    temporary = os.path.join(path, MANIFEST + '.tmp')
+    with open(temporary, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, ensure_ascii=False)
+    os.replace(temporary, os.path.join(path, MANIFEST))
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def read_tail(path, manifest, name, rows):
+
+    # Last rows of one array, read straight from the end of its file
+    spec = manifest['arrays'][name]
+    width = spec['width'] or 1
+    itemsize = np.dtype(spec['dtype']).itemsize
+    rows = min(rows, manifest['rows'])
+
+    with open(os.path.join(path, spec['file']), 'rb') as f:
+        f.seek((manifest['rows'] - rows) * width * itemsize)
+        values = np.fromfile(f, dtype=spec['dtype'], count=rows * width)
+
+    return values.reshape(rows, width) if spec['width'] else values
+
+
+def last_date(manifest, path):
+    if not manifest['rows']:
+        return None
+    return np.datetime64(int(read_tail(path, manifest, 'dates', 1)[0]), 'D')
+
+
+def write_dataset(path, dates, districts, arrays, population=None):
+
+    os.makedirs(path, exist_ok=True)
+
+    days = np.asarray(dates, dtype='datetime64[D]').astype('<i8')
+    manifest = {'format': FORMAT,
+                'rows': len(days),
+                'districts': list(districts),
+                'population': None if population is None else {district: int(population[district]) for district in districts if district in population},
+                'arrays': {'dates': {'file': 'dates.bin', 'dtype': '<i8', 'width': 0}}}
+
+    files = [(manifest['arrays']['dates']['file'], days)]
+    for name, dtype in ARRAYS.items():
+        values = np.asarray(arrays[name]).astype(dtype)
+        assert values.shape == (len(days), len(districts)), name
+        manifest['arrays'][name] = {'file': name + '.bin', 'dtype': dtype, 'width': len(districts)}
+        files.append((manifest['arrays'][name]['file'], values))
+
+    # New array files go in under temporary names first, then the manifest switches over to them
+    for file, values in files:
+        np.ascontiguousarray(values).tofile(os.path.join(path, file + '.tmp'))
+    for file, values in files:
+        os.replace(os.path.join(path, file + '.tmp'), os.path.join(path, file))
+
+    manifest['version'] = array_version('', *(values for file, values in files))
+    write_manifest(path, manifest)
+
+    return manifest
+
+
+def append_rows(path, dates, arrays):
+
+    # Add rows for new dates to the end of every array file, then publish them by rewriting the manifest.
+    # Readers that mapped the old manifest keep seeing the old row count, so they're never handed half an update
+    manifest = read_manifest(path)
+    days = np.asarray(dates, dtype='datetime64[D]').astype('<i8')
+    if not len(days):
+        return manifest
+
+    chunks = {'dates': days}
+    for name, dtype in ARRAYS.items():
+        chunks[name] = np.ascontiguousarray(np.asarray(arrays[name]).astype(dtype))
+
+    for name, values in chunks.items():
+        spec = manifest['arrays'][name]
+        assert len(values) == len(days) and values.size == len(days) * (spec['width'] or 1), name
+
+        # Cut off anything a failed earlier append left past the published rows before adding ours
+        with open(os.path.join(path, spec['file']), 'r+b') as f:
+            f.truncate(manifest['rows'] * (spec['width'] or 1) * np.dtype(spec['dtype']).itemsize)
+            f.seek(0, os.SEEK_END)
+            values.tofile(f)
+
+    manifest['rows'] += len(days)
+    manifest['version'] = array_version(manifest['version'], *chunks.values())
+    write_manifest(path, manifest)
+
+    return manifest
+
+
+def wide(frame, column, dates, districts):
+
+    # Pivot a long (Date index, District column) frame to a dates x districts matrix
+    return frame.reset_index().pivot(index='Date', columns='District', values=column).reindex(index=dates, columns=districts)
+
+
+def from_long_frames(path, rolling_7_long, incidence, population=None):
+
+    # Shared date axis and district order, taken from the daily table which starts before the rolling one.
+    # Districts go in region code order, so a district's column is its code
+    dates = pd.DatetimeIndex(incidence.index.unique()).sort_values()
+    present = set(incidence['District'].unique())
+    districts = [name for name in regions.categories(incidence['District']) if name in present]
+
+    arrays = {'daily_cases': wide(incidence, 'Cases', dates, districts).values,
+              'rolling_cases': wide(rolling_7_long, 'Cases', dates, districts).values,
+              'incidence': wide(incidence, 'Incidence', dates, districts).values}
+
+    # Every window metric from one cumulative sum over the daily cases
+    district_population = np.full(len(districts), np.nan) if population is None else pd.Series(population, dtype=float).reindex(districts).values
+    arrays.update(metrics.compute_metrics(arrays['daily_cases'], district_population))
+
+    return write_dataset(path, dates, districts, arrays, population)
+
+
+if __name__ == '__main__':
+
+    # Convert the CSVs in this directory, e.g. `python columnar.py data`
+    here = os.path.dirname(os.path.abspath(__file__))
+    rolling_7_long = pd.read_csv(os.path.join(here, 'rolling_7_long.csv'), parse_dates=['Date'], index_col='Date')
+    incidence = pd.read_csv(os.path.join(here, 'incidence.csv'), parse_dates=['Date'], index_col='Date')
+
+    # The CSVs don't carry population, but every day with cases gives it back exactly as cases / incidence * 100000
+    with_cases = incidence[incidence['Incidence'] > 0]
+    population = (with_cases['Cases'] / with_cases['Incidence'] * 100000).groupby(with_cases['District']).median().round()
+
+    from_long_frames(sys.argv[1] if len(sys.argv) > 1 else os.path.join(here, 'data'), rolling_7_long, incidence, population)
@@ -2,39 +2,86 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 
-# Web scraping using BeautifulSoup and converting to pandas dataframe
+# Web scraping straight from the page into pandas dataframes
 import requests
 import urllib.request
 import json # library to handle JSON files
-from pandas.io.json import json_normalize # tranform JSON file into a pandas dataframe
-from urllib.request import urlopen
-from bs4 import BeautifulSoup
+import os
+import argparse
+
+import columnar
+import fetch
+import metrics
+import regions
+from extract import read_table
+
+# Where the binary columnar copy for the dashboard goes
+DATA_DIR = os.environ.get('COVID_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+
+# Pages we scrape. The case table changes daily so it's always revalidated, the census table is left alone for a month
+SOURCES = {'cases': fetch.Source('https://www.berlin.de/lageso/gesundheit/infektionsepidemiologie-infektionsschutz/corona/tabelle-bezirke-gesamtuebersicht/', ttl=0),
+           'population': fetch.Source('https://en.wikipedia.org/wiki/Demographics_of_Berlin', ttl=30 * 24 * 3600)}
+
+# Pages fetched up front by fetch_pages, by source name
+pages = {}
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.max_rows', None)
 
-def covid_scrape():
-    global covid_raw
-    url1 = ('https://www.berlin.de/lageso/gesundheit/infektionsepidemiologie-infektionsschutz/corona/tabelle-bezirke-gesamtuebersicht/')
-    site1 = urlopen(url1)
-    soup1 = BeautifulSoup(site1, 'lxml')
+def fetch_pages(names=SOURCES):
+
+    global pages
+    # Fetch the sources concurrently through the HTTP cache
+    pages = fetch.fetch_all({name: SOURCES[name] for name in names})
+
+    return pages
+
+def source_page(name):
+    return pages[name] if name in pages else fetch.fetch(SOURCES[name])
 
-    # Create table object to extract the raw table inside that webpage
-    table1 = soup1.find_all('table')
+def rows_after(last):
 
-    # Scrape just the new case by district table, which is the 1st table and convert it into a dataframe
-    covid_raw = pd.read_html(str(table1[0]), index_col=None, header=0)[0]
+    # Row filter for the case table that keeps days after last and drops rows that aren't dated (the blank one at the end).
+    # Dates in the table's dd.mm.yyyy form are compared as yyyymmdd strings, anything else goes through pandas
+    last_day = last.strftime('%Y%m%d')
+    newer = []
+
+    def keep(text):
+        text = text.strip()
+        if len(text) == 10 and text[2] == text[5] == '.' and (text[:2] + text[3:5] + text[6:]).isdigit():
+            day = text[6:] + text[3:5] + text[:2]
+        else:
+            date = pd.to_datetime(text, dayfirst=True, errors='coerce')
+            if pd.isna(date):
+                return False
+            day = date.strftime('%Y%m%d')
+        if day > last_day:
+            newer.append(day)
+            return True
+
+        # A day we have after newer ones means the table runs newest first, so the rest of it is older still
+        return None if newer else False
+
+    return keep
+
+def covid_scrape(after=None):
+    global covid_raw
+    site1 = source_page('cases')
+
+    # Scrape just the new case by district table, which is the 1st table, straight into a dataframe.
+    # With a date, rows up to it are dropped while the page is parsed
+    covid_raw = read_table(site1.body, index=0, header=0, encoding=site1.charset, keep=None if after is None else rows_after(after))
 
     return covid_raw
 
 
 def covid_wide_dataframe():
     global covid
-    # Change column names to English and spell out district acroynyms. Remove the last row of null values
-    covid = covid_raw.rename(columns={'Datum': 'Date', 'MI': 'Mitte', 'FK':'Friedrichshain-Kreuzberg', 'PA':'Pankow', 'CW': 'Charlottenburg-Wilmersdorf', 'SP':'Spandau', 'SZ':'Steglitz-Zehlendorf','TS':'Tempelhof-Schöneberg','NK':'Neukölln','TK':'Treptow-Köpenick','MH':'Marzahn-Hellersdorf','LI':'Lichtenberg','RD':'Reinickendorf'}).dropna()
+    # Change column names to English and spell out district acroynyms from the region registry. Remove the last row of null values
+    covid = covid_raw.rename(columns=dict(regions.RENAME, Datum='Date')).dropna()
 
     # Non-date values are floats. Change data type of values to integers. Change type of Date column to datetime
-    covid = covid.astype({'Mitte':int, 'Friedrichshain-Kreuzberg':int,'Pankow':int,'Charlottenburg-Wilmersdorf':int,'Spandau':int,'Steglitz-Zehlendorf':int,'Tempelhof-Schöneberg':int,'Neukölln':int,'Treptow-Köpenick':int, 'Marzahn-Hellersdorf':int,'Lichtenberg':int,'Reinickendorf':int})
+    covid = covid.astype({name: int for name in regions.NAMES})
 
     covid['Date'] = pd.to_datetime(covid['Date'].str.strip(), infer_datetime_format=True, dayfirst=True).dt.strftime('%Y-%m-%d')
 
@@ -46,6 +93,9 @@ def covid_long_dataframe():
     # Convert to long format using .melt. Set variable name to District and value name to Cases
     covid_long = covid.melt(id_vars=['Date'], var_name = 'District', value_name='Cases')
 
+    # Store District as region codes rather than repeating the name on every row
+    covid_long['District'] = regions.categorical(covid_long['District'])
+
     # Set index to Date
     covid_long.set_index('Date', inplace=True)
 
@@ -76,6 +126,7 @@ def rolling_7_dataframe():
 
     # Convert to long format using .melt. Set variable name to District and value name to Cases
     rolling_7_long = rolling_7_long.melt(id_vars=['Date'], var_name = 'District', value_name='Cases').dropna()
+    rolling_7_long['District'] = regions.categorical(rolling_7_long['District'])
 
     # Set index to Date
     rolling_7_long.set_index('Date', inplace=True)
@@ -85,15 +136,10 @@ def rolling_7_dataframe():
 def population_scrape():
 
         global population_raw
-        url2 = ('https://en.wikipedia.org/wiki/Demographics_of_Berlin')
-        site2 = urlopen(url2)
-        soup2 = BeautifulSoup(site2, 'lxml')
-
-        # Create table object to extract the raw table inside that webpage
-        table2 = soup2.find_all('table')
+        site2 = source_page('population')
 
-        # Scrape just population by district table, which is the 3rd table and convert it into a dataframe
-        population_raw = pd.read_html(str(table2[4]), index_col=None, header=0)[0]
+        # Scrape just population by district table, which is the 5th table, straight into a dataframe
+        population_raw = read_table(site2.body, index=4, header=0, encoding=site2.charset)
 
         return population_raw
 
@@ -117,24 +163,95 @@ def incidence_dataframe():
         global incidence
 
         # Calculate incidence per 100000
-        # Assign new Incidence column by mapping District from cases dataframe to index of population dataframe, dividing cases by population, multiplying by 100000
-        incidence = covid_long.assign(Incidence=(covid_long.Cases / covid_long.District.map(population.set_index('District')['Population 2010']))*100000).dropna()
+        # Line population up with the District categories once, then look it up per row by region code, divide cases by population, multiply by 100000
+        population_by_code = population.set_index('District')['Population 2010'].reindex(covid_long.District.cat.categories).values
+        incidence = covid_long.assign(Incidence=(covid_long.Cases / regions.lookup(population_by_code, covid_long.District.cat.codes))*100000).dropna()
 
         return incidence
 
-covid_scrape()
-covid_wide_dataframe()
-covid_long_dataframe()
-rolling_7_dataframe()
-population_scrape()
-population_dataframe()
-incidence_dataframe()
-
-# Export needed dataframes as csv
-#covid_raw.to_csv(r'/users/hpoola/Desktop/covid_raw.csv')
-#covid.to_csv(r'/users/hpoola/Desktop/covid.csv')
-#covid_long.to_csv(r'/users/hpoola/Desktop/covid_long.csv')
-rolling_7_long.to_csv(r'/users/hpoola/Desktop/berlin_covid_dash/rolling_7_long.csv')
-#population_raw.to_csv(r'/users/hpoola/Desktop/population_raw.csv')
-#population.to_csv(r'/users/hpoola/Desktop/population.csv')
-incidence.to_csv(r'/users/hpoola/Desktop/berlin_covid_dash/incidence.csv')
+def export_dataset(path=DATA_DIR):
+
+        # Write the memory-mappable copy of the rolling and incidence tables the dashboard reads
+        return columnar.from_long_frames(path, rolling_7_long, incidence, population.set_index('District')['Population 2010'])
+
+def incremental_update(path=DATA_DIR, raw=None):
+
+        global covid_raw
+
+        # Last date we already have in the columnar dataset
+        manifest = columnar.read_manifest(path)
+        last = columnar.last_date(manifest, path)
+        districts = manifest['districts']
+
+        # Download the table (unless we're handed one) and keep only rows for days after that
+        if raw is None:
+            covid_scrape(after=None if last is None else pd.Timestamp(last).to_pydatetime())
+        else:
+            covid_raw = raw
+        raw_dates = pd.to_datetime(covid_raw['Datum'].astype(str).str.strip(), dayfirst=True, errors='coerce')
+        if last is not None:
+            covid_raw = covid_raw[raw_dates > pd.Timestamp(last)]
+        if covid_raw.empty:
+            return manifest
+
+        # Same clean up as the full run, on the new rows only
+        covid_wide_dataframe()
+        new_cases = covid.set_index(pd.to_datetime(covid['Date'])).sort_index()[districts]
+        if new_cases.empty:
+            return manifest
+
+        # The windows for the new days reach back into what's stored: 6 rows for the 7-day mean, more for the longer metrics
+        tail = columnar.read_tail(path, manifest, 'daily_cases', metrics.tail_rows())
+        window = np.vstack([tail, new_cases.values])
+        rolling = pd.DataFrame(window).rolling(7).mean().values[len(tail):]
+
+        # Population from the dataset, or from Wikipedia if it wasn't stored
+        if manifest.get('population'):
+            district_population = pd.Series(manifest['population'])
+        else:
+            population_scrape()
+            population_dataframe()
+            district_population = population.set_index('District')['Population 2010']
+        district_population = district_population.reindex(districts).values.astype(float)
+        incidence_new = new_cases.values / district_population * 100000
+
+        arrays = {'daily_cases': new_cases.values,
+                  'rolling_cases': rolling,
+                  'incidence': incidence_new}
+        arrays.update(metrics.update_metrics(tail, new_cases.values, district_population))
+
+        return columnar.append_rows(path, new_cases.index.values, arrays)
+
+def full_update():
+    fetch_pages()
+    covid_scrape()
+    covid_wide_dataframe()
+    covid_long_dataframe()
+    rolling_7_dataframe()
+    population_scrape()
+    population_dataframe()
+    incidence_dataframe()
+
+    # Export needed dataframes as csv
+    #covid_raw.to_csv(r'/users/hpoola/Desktop/covid_raw.csv')
+    #covid.to_csv(r'/users/hpoola/Desktop/covid.csv')
+    #covid_long.to_csv(r'/users/hpoola/Desktop/covid_long.csv')
+    rolling_7_long.to_csv(r'/users/hpoola/Desktop/berlin_covid_dash/rolling_7_long.csv')
+    #population_raw.to_csv(r'/users/hpoola/Desktop/population_raw.csv')
+    #population.to_csv(r'/users/hpoola/Desktop/population.csv')
+    incidence.to_csv(r'/users/hpoola/Desktop/berlin_covid_dash/incidence.csv')
+
+    # And as the binary columnar dataset
+    export_dataset()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scrape Berlin covid cases by district')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only add days newer than the columnar dataset in COVID_DATA_DIR (the CSVs are left as they are)')
+    args = parser.parse_args()
+
+    # Incremental runs need a dataset to add to, so the first run is always a full one
+    if args.incremental and os.path.exists(os.path.join(DATA_DIR, columnar.MANIFEST)):
+        incremental_update()
+    else:
+        full_update()
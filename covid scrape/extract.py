@@ -0,0 +1,88 @@
+import io
+
+import numpy as np
+import pandas as pd
+from lxml import etree
+
+# Single pass table extraction. The page is streamed through lxml's HTML parser, parsing stops once the wanted table
+# has been read, and its cells go straight into typed columns instead of being turned back into a string for read_html.
+
+
+def cell_text(cell):
+    return ' '.join(''.join(cell.itertext()).split())
+
+
+def table_rows(source, index, encoding=None, keep=None):
+
+    # source is the page as bytes, text or a file-like object. Tables are counted in document order like find_all('table').
+    # Without an encoding lxml goes by the page's own meta charset. keep, if given, sees every row of the table as it's
+    # parsed, as (position in the table, text of its first cell), and returns True to keep it, False to drop it, or
+    # None when the rest of the table isn't needed. Only kept rows have their cells read
+    if isinstance(source, str):
+        source, encoding = source.encode('utf-8'), 'utf-8'
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+
+    seen = -1
+    open_tables = []
+    rows = []
+    position = 0
+    for event, element in etree.iterparse(source, events=('start', 'end'), tag=('table', 'tr'), html=True, encoding=encoding):
+        if element.tag == 'tr':
+            if event == 'end' and open_tables and open_tables[-1] == index:
+                cells = [cell for cell in element if cell.tag in ('td', 'th')]
+                decision = True if keep is None else keep(position, cell_text(cells[0]) if cells else '')
+                if decision is None:
+                    return rows
+                if decision:
+                    rows.append([cell_text(cell) for cell in cells])
+                position += 1
+
+                # Rows are dropped once read, so a long table doesn't build up a tree
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+            continue
+
+        if event == 'start':
+            seen += 1
+            open_tables.append(seen)
+            continue
+
+        if open_tables.pop() == index:
+            return rows
+
+        # Tables before the one we want are dropped as soon as they're closed
+        element.clear()
+
+    raise IndexError('page has no table {}'.format(index))
+
+
+def typed_column(values):
+
+    # Numbers (with ',' thousands separators) become int64 if they're all whole and present, float64 with NaN
+    # for blanks otherwise. Anything else stays as strings with NaN for blanks, like read_html
+    cleaned = [value.replace(',', '') for value in values]
+    try:
+        numbers = np.array([float(value) if value else np.nan for value in cleaned])
+    except ValueError:
+        return np.array([value if value else np.nan for value in values], dtype=object)
+
+    if len(numbers) and not np.isnan(numbers).any() and (numbers == np.round(numbers)).all():
+        return numbers.astype(np.int64)
+
+    return numbers
+
+
+def read_table(source, index=0, header=0, encoding=None, keep=None):
+
+    # keep, if given, is asked about every row after the header by its first cell, as for table_rows
+    rows = table_rows(source, index, encoding, None if keep is None else lambda position, first: position <= header or keep(first))
+    names = rows[header]
+    body = rows[header + 1:]
+
+    # Short rows are padded with blanks so every column has a value per row
+    width = len(names)
+    body = [row[:width] + [''] * (width - len(row)) for row in body]
+
+    return pd.DataFrame({name: typed_column([row[i] for row in body]) for i, name in enumerate(names)}, columns=names)
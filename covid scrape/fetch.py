@@ -0,0 +1,111 @@
+import os
+import time
+import json
+import hashlib
+import http.client
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+
+# Fetching the scrape sources: all of them at once, through an on-disk cache that revalidates with
+# ETag / Last-Modified, so a source that hasn't changed costs a 304 (or nothing at all inside its TTL).
+
+CACHE_DIR = os.environ.get('COVID_HTTP_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.http_cache'))
+
+# A page to fetch. ttl is how many seconds a cached copy is used without asking the server again
+Source = namedtuple('Source', ['url', 'ttl'])
+
+# What we got back. status is 200 for a fresh download, 304 when the server confirmed our copy, and
+# 'cached' or 'stale' when we didn't (or couldn't) ask
+Page = namedtuple('Page', ['url', 'body', 'charset', 'status'])
+
+
+def cache_paths(url, cache_dir):
+    key = hashlib.sha1(url.encode()).hexdigest()
+    return os.path.join(cache_dir, key + '.body'), os.path.join(cache_dir, key + '.json')
+
+
+def read_cache(url, cache_dir):
+    body_path, meta_path = cache_paths(url, cache_dir)
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        with open(body_path, 'rb') as f:
+            return meta, f.read()
+    except (OSError, ValueError):
+        return None, None
+
+
+def write_cache(url, cache_dir, meta, body=None):
+
+    # Body first, then the metadata that points at it, each renamed into place
+    os.makedirs(cache_dir, exist_ok=True)
+    body_path, meta_path = cache_paths(url, cache_dir)
+    if body is not None:
+        with open(body_path + '.tmp', 'wb') as f:
+            f.write(body)
+        os.replace(body_path + '.tmp', body_path)
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def fetch(source, cache_dir=CACHE_DIR, retries=3, backoff=1.0, timeout=30):
+
+    meta, body = read_cache(source.url, cache_dir)
+
+    # Fresh enough, don't even ask
+    if meta and time.time() - meta['fetched'] < source.ttl:
+        return Page(source.url, body, meta['charset'], 'cached')
+
+    # Otherwise ask whether our copy is still current
+    headers = {'User-Agent': 'berlin-covid-dashboard'}
+    if meta and meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta and meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    for attempt in range(retries + 1):
+        try:
+            with urlopen(Request(source.url, headers=headers), timeout=timeout) as response:
+                body = response.read()
+                meta = {'fetched': time.time(),
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                        'charset': response.headers.get_content_charset()}
+            write_cache(source.url, cache_dir, meta, body)
+            return Page(source.url, body, meta['charset'], 200)
+
+        except HTTPError as error:
+            if error.code == 304 and meta:
+                meta['fetched'] = time.time()
+                write_cache(source.url, cache_dir, meta)
+                return Page(source.url, body, meta['charset'], 304)
+
+            # Client errors won't go away by asking again
+            if error.code < 500 and error.code != 429:
+                raise
+            failure = error
+
+        # Connection failures, and timeouts or dropped connections while reading the body
+        except (URLError, OSError, http.client.HTTPException) as error:
+            failure = error
+
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+
+    # Out of retries: an old copy is better than nothing
+    if meta:
+        return Page(source.url, body, meta['charset'], 'stale')
+
+    raise failure
+
+
+def fetch_all(sources, cache_dir=CACHE_DIR, **kwargs):
+
+    # sources maps names to Source. Every source is fetched on its own thread
+    with ThreadPoolExecutor(max_workers=max(1, len(sources))) as executor:
+        futures = {name: executor.submit(fetch, source, cache_dir, **kwargs) for name, source in sources.items()}
+
+        return {name: future.result() for name, future in futures.items()}
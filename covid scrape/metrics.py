@@ -0,0 +1,74 @@
+import numpy as np
+
+# Rolling window metrics for every district from one cumulative sum of the daily cases matrix.
+# A window's sum is the difference of two rows of the running total, so each extra window is a subtraction
+# rather than another rolling pass over the data.
+
+# Window lengths in days (rows of the table, like covid.rolling(7))
+WINDOWS = (7, 14, 28)
+
+# Week over week growth compares the 7-day sum with the one a week earlier
+GROWTH_WINDOW = 7
+
+
+def metric_names(windows=WINDOWS):
+    names = []
+    for window in windows:
+        names += ['cases_{}d'.format(window), 'incidence_{}d'.format(window)]
+
+    return names + ['growth_wow']
+
+
+def tail_rows(windows=WINDOWS):
+
+    # Stored rows an incremental update needs before the new ones so every window for them is complete
+    return max(max(windows), 2 * GROWTH_WINDOW) - 1
+
+
+def window_sums(cumulative, window):
+
+    # cumulative has a leading row of zeros, so the sum of rows (i - window, i] is cumulative[i + 1] - cumulative[i + 1 - window].
+    # Rows without a full window are NaN, like rolling().sum()
+    rows = len(cumulative) - 1
+    sums = np.full((rows,) + cumulative.shape[1:], np.nan)
+    if rows >= window:
+        sums[window - 1:] = cumulative[window:] - cumulative[:-window]
+
+    return sums
+
+
+def compute_metrics(daily_cases, population, windows=WINDOWS):
+
+    # daily_cases is dates x districts, population one value per district (NaN where unknown)
+    daily_cases = np.asarray(daily_cases, dtype=float)
+    per_100k = 100000 / np.asarray(population, dtype=float)
+
+    cumulative = np.zeros((len(daily_cases) + 1,) + daily_cases.shape[1:])
+    np.cumsum(daily_cases, axis=0, out=cumulative[1:])
+
+    metrics = {}
+    for window in set(windows) | {GROWTH_WINDOW}:
+        sums = window_sums(cumulative, window)
+        if window in windows:
+            metrics['cases_{}d'.format(window)] = sums
+            metrics['incidence_{}d'.format(window)] = sums * per_100k
+        if window == GROWTH_WINDOW:
+            weekly = sums
+
+    # Growth against the previous week's sum. NaN when there's nothing to compare with or it was zero
+    growth = np.full(weekly.shape, np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        growth[GROWTH_WINDOW:] = weekly[GROWTH_WINDOW:] / weekly[:-GROWTH_WINDOW] - 1
+    growth[~np.isfinite(growth)] = np.nan
+    metrics['growth_wow'] = growth
+
+    return {name: metrics[name] for name in metric_names(windows)}
+
+
+def update_metrics(tail_cases, new_cases, population, windows=WINDOWS):
+
+    # Metrics for just the new rows, from the stored tail (tail_rows() of them) plus the new rows
+    cases = np.vstack([np.asarray(tail_cases, dtype=float).reshape(-1, np.shape(new_cases)[1]), new_cases])
+    metrics = compute_metrics(cases, population, windows)
+
+    return {name: values[-len(new_cases):] for name, values in metrics.items()}
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+# Registry of the regions we report on. A region's code is its position in REGIONS, and long tables store District as a
+# categorical over these names so each row holds a small integer code instead of its own copy of the name.
+
+# (acronym in the LAGeSo table, name we use everywhere else)
+REGIONS = [('MI', 'Mitte'),
+           ('FK', 'Friedrichshain-Kreuzberg'),
+           ('PA', 'Pankow'),
+           ('CW', 'Charlottenburg-Wilmersdorf'),
+           ('SP', 'Spandau'),
+           ('SZ', 'Steglitz-Zehlendorf'),
+           ('TS', 'Tempelhof-Schöneberg'),
+           ('NK', 'Neukölln'),
+           ('TK', 'Treptow-Köpenick'),
+           ('MH', 'Marzahn-Hellersdorf'),
+           ('LI', 'Lichtenberg'),
+           ('RD', 'Reinickendorf')]
+
+ACRONYMS = [acronym for acronym, name in REGIONS]
+NAMES = [name for acronym, name in REGIONS]
+
+# Acronym to name, for renaming the table header
+RENAME = dict(REGIONS)
+
+CODES = {name: code for code, name in enumerate(NAMES)}
+
+
+def categories(names):
+
+    # Registry names first so codes are stable, then anything else in order of appearance
+    extra = [name for name in pd.unique(pd.Series(names, dtype=object)) if name not in CODES]
+
+    return NAMES + extra
+
+
+def categorical(names):
+    values = pd.Series(names, dtype=object)
+    return pd.Categorical(values, categories=categories(values))
+
+
+def lookup(values, codes):
+
+    # Per-row values from a per-region array (indexed by code), without comparing any strings
+    return np.asarray(values)[np.asarray(codes)]
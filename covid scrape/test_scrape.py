@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import columnar
+import covid_scrape
+import fetch
+from extract import read_table
+from benchmark import synthetic_raw, synthetic_pages, synthetic_population, lageso_page, local_server, full_build
+
+# What the fetch cache and the incremental update have to do, without the timings in benchmark.py.
+# Run with pytest, or `python test_scrape.py`
+
+PAGES = {'/cases': synthetic_pages(30)['lageso (table 0)'][0], '/population': synthetic_pages(12)['wikipedia (table 4)'][0]}
+
+
+def read_arrays(path):
+    manifest = columnar.read_manifest(path)
+    return {name: columnar.read_tail(path, manifest, name, manifest['rows']) for name in manifest['arrays']}
+
+
+def serve(stalled=()):
+    server, log = local_server(PAGES, 0, stalled)
+    return server, log, 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_revalidates_and_honours_ttl():
+    server, log, base = serve()
+    workdir = tempfile.mkdtemp()
+    try:
+        sources = {'cases': fetch.Source(base + '/cases', ttl=0), 'population': fetch.Source(base + '/population', ttl=3600)}
+        cold = fetch.fetch_all(sources, workdir)
+        assert [page.status for page in cold.values()] == [200, 200]
+
+        # The case page is revalidated, the population page is inside its TTL and not asked for at all
+        del log[:]
+        warm = fetch.fetch_all(sources, workdir)
+        assert warm['cases'].status == 304 and warm['population'].status == 'cached' and log == [304]
+        assert all(warm[name].body == PAGES['/' + name] for name in warm)
+    finally:
+        stop(server)
+        shutil.rmtree(workdir)
+
+
+def test_fetch_falls_back_to_cache_when_body_stalls():
+    stalled = set()
+    server, log, base = serve(stalled)
+    workdir = tempfile.mkdtemp()
+    try:
+        source = fetch.Source(base + '/cases', ttl=0)
+        fetch.fetch(source, workdir)
+
+        # Headers arrive, the body never does: the read times out, is retried, then the cached copy is used
+        stalled.add('/cases')
+        page = fetch.fetch(source, workdir, retries=1, backoff=0.01, timeout=0.5)
+        assert page.status == 'stale' and page.body == PAGES['/cases']
+    finally:
+        stop(server)
+        shutil.rmtree(workdir)
+
+
+def test_fetch_falls_back_to_cache_when_server_is_down():
+    server, log, base = serve()
+    workdir = tempfile.mkdtemp()
+    try:
+        source = fetch.Source(base + '/cases', ttl=0)
+        fetch.fetch(source, workdir)
+        stop(server)
+
+        page = fetch.fetch(source, workdir, retries=1, backoff=0.01, timeout=1)
+        assert page.status == 'stale' and page.body == PAGES['/cases']
+
+        # Without a cached copy there's nothing to fall back to
+        try:
+            fetch.fetch(fetch.Source(base + '/population', ttl=0), workdir, retries=1, backoff=0.01, timeout=1)
+        except OSError:
+            pass
+        else:
+            raise AssertionError('fetch without a server or cache should raise')
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_incremental_update_matches_full_rebuild():
+    population = synthetic_population()
+    raw = synthetic_raw(60)
+    workdir = tempfile.mkdtemp()
+    try:
+        # Seed with 30 days, then add the rest one day at a time from that day's page
+        path = os.path.join(workdir, 'incremental')
+        full_build(raw.iloc[:30], population, path)
+        for day in range(31, 61):
+            covid_scrape.pages = {'cases': fetch.Page('', lageso_page(pd.concat([raw.iloc[:day], raw.iloc[-1:]])), 'utf-8', 200)}
+            covid_scrape.incremental_update(path)
+
+        # A page without new days changes nothing
+        version = columnar.read_manifest(path)['version']
+        covid_scrape.incremental_update(path)
+        assert columnar.read_manifest(path)['version'] == version
+
+        full_build(raw, population, os.path.join(workdir, 'full'))
+        expected = read_arrays(os.path.join(workdir, 'full'))
+        actual = read_arrays(path)
+        for name in expected:
+            np.testing.assert_allclose(actual[name], expected[name], err_msg=name)
+    finally:
+        covid_scrape.pages = {}
+        shutil.rmtree(workdir)
+
+
+def test_rows_after_keeps_only_new_days():
+    raw = synthetic_raw(20)
+    last = pd.to_datetime(raw['Datum'].iloc[-4], dayfirst=True).to_pydatetime()
+    new_days = raw['Datum'].iloc[-3:-1].tolist()
+
+    rows = read_table(lageso_page(raw), keep=covid_scrape.rows_after(last))
+    assert rows['Datum'].tolist() == new_days
+
+    # Newest first, the read stops at the first day already stored
+    asked = []
+    keep = covid_scrape.rows_after(last)
+    rows = read_table(lageso_page(pd.concat([raw.iloc[-2::-1], raw.iloc[-1:]])), keep=lambda first: asked.append(first) or keep(first))
+    assert rows['Datum'].tolist() == new_days[::-1] and len(asked) == 3
+
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'passed')